@@ -8,218 +8,1782 @@
 """
 
 # Imports externals
+import errno
 import fnmatch
+import json
 import logging
+import mmap
+import multiprocessing
 import optparse
 import os
 import re
+import select
+import shutil
+import signal
+import struct
 import subprocess
 import sys
 import tempfile
+import time
 
 # Imports internals
 
 
+def humanizeSize(amount):
+  for prefix in ('', 'Ki', 'Mi', 'Gi', 'Ti'):
+    if amount < 1024:
+      break
+    amount /= 1024.0
+  return '%.1f %sB' % (amount, prefix)
+
+
+def humanizeLatency(microseconds):
+  if microseconds < 1000:
+    return '%dus' % microseconds
+  if microseconds < 1000000:
+    return '%.2fms' % (microseconds / 1000.0)
+  return '%.2fs' % (microseconds / 1000000.0)
+
+
+class Histogram(object):
+  """
+  Log-bucketed histogram of non negative integers, HDR style: values below
+  SUB_BUCKETS are exact and the rest fall in SUB_BUCKETS buckets per power
+  of two, so the relative error stays under 1/SUB_BUCKETS and there are at
+  most SUB_BUCKETS buckets per value bit. Histograms merge by adding counts.
+  """
+  SUB_BITS = 4
+  SUB_BUCKETS = 1 << SUB_BITS
+
+  def __init__(self):
+    object.__init__(self)
+    self.__counts = dict()
+    self.__count = 0
+    self.__total = 0
+    self.__max = 0
+
+  def __index(self, value):
+    if value < self.SUB_BUCKETS:
+      return value
+    shift = value.bit_length() - self.SUB_BITS - 1
+    return (shift + 1) * self.SUB_BUCKETS + (value >> shift) - self.SUB_BUCKETS
+
+  def __bounds(self, index):
+    if index < self.SUB_BUCKETS:
+      return index, index
+    shift, top = divmod(index - self.SUB_BUCKETS, self.SUB_BUCKETS)
+    low = (self.SUB_BUCKETS + top) << shift
+    return low, low + (1 << shift) - 1
+
+  def add(self, value, qty=1):
+    index = self.__index(value)
+    self.__counts[index] = self.__counts.get(index, 0) + qty
+    self.__count += qty
+    self.__total += value * qty
+    self.__max = max(self.__max, value)
+
+  def merge(self, other):
+    for index, qty in other.__counts.iteritems():
+      self.__counts[index] = self.__counts.get(index, 0) + qty
+    self.__count += other.__count
+    self.__total += other.__total
+    self.__max = max(self.__max, other.__max)
+    return self
+
+  def getState(self):
+    return self.__counts, self.__count, self.__total, self.__max
+
+  def setState(self, counts, count, total, maximum):
+    self.__counts, self.__count, self.__total, self.__max = counts, count, total, maximum
+
+  def getCount(self):
+    return self.__count
+
+  def getTotal(self):
+    return self.__total
+
+  def getMax(self):
+    return self.__max
+
+  def getPercentile(self, percent):
+    """
+    Returns the highest value equivalent to the given percentile.
+    """
+    rank = max(1, int(self.__count * percent / 100.0 + 0.5))
+    seen = 0
+    for index in sorted(self.__counts):
+      seen += self.__counts[index]
+      if seen >= rank:
+        return min(self.__bounds(index)[1], self.__max)
+    return self.__max
+
+  def getBuckets(self):
+    """
+    Returns the (lowest value, highest value, count) of the used buckets.
+    """
+    return [self.__bounds(index) + (self.__counts[index], ) for index in sorted(self.__counts)]
+
+  def describe(self):
+    return 'p50 %s, p90 %s, p99 %s, max %s' % tuple([humanizeLatency(value) for value in
+        (self.getPercentile(50), self.getPercentile(90), self.getPercentile(99), self.__max)])
+
+
+def toMicroseconds(time):
+  return int(round(time * 1000000))
+
+
 class File(object):
+  """
+  I/O statistics of an open file: size and latency histograms per operation.
+  The file position is tracked so every read and write offset is classified
+  as sequential (right after the previous one), strided (same distance as
+  the previous jump) or random.
+  """
+  SEQUENTIAL, RANDOM, STRIDED = range(3)
 
-  def __init__(self, filename):
+  def __init__(self, filename, append=False):
     object.__init__(self)
     self.__filename = filename
-    self.__writeLog = dict()
-    self.__writeTime = 0.0
-    self.__readLog = dict()
-    self.__readTime = 0.0
+    self.__append = append
+    self.__writeSizes = Histogram()
+    self.__writeLatency = Histogram()
+    self.__readSizes = Histogram()
+    self.__readLatency = Histogram()
+    self.__position = 0
+    self.__seeked = False
+    self.__lastOffset = None
+    self.__lastEnd = None
+    self.__lastStride = None
+    self.__patterns = [0, 0, 0]
+    self.__syncLatency = Histogram()
+    self.__mmaps = 0
+    self.__mappedBytes = 0
 
   def getFilename(self):
     return self.__filename
 
-  def write(self, amount, time):
-    if self.__writeLog.has_key(amount):
-      self.__writeLog[amount] += 1
-    else:
-      self.__writeLog[amount] = 1
-    self.__writeTime += time
+  def getTotals(self):
+    """
+    Returns the (read bytes, written bytes, operations, time) of the file.
+    """
+    return (self.__readSizes.getTotal(),
+        self.__writeSizes.getTotal(),
+        self.__readSizes.getCount() + self.__writeSizes.getCount(),
+        (self.__readLatency.getTotal() + self.__writeLatency.getTotal()) / 1000000.0)
+
+  def getHistograms(self):
+    """
+    Returns the read and write (sizes, latency) and the sync latency histograms.
+    """
+    return ((self.__readSizes, self.__readLatency),
+        (self.__writeSizes, self.__writeLatency),
+        self.__syncLatency)
+
+  def getState(self):
+    """
+    Returns the counters and the histograms of the file, as saved.
+    """
+    return ([self.__mmaps, self.__mappedBytes] + self.__patterns,
+        [self.__readSizes, self.__readLatency, self.__writeSizes, self.__writeLatency,
+            self.__syncLatency])
+
+  def setState(self, counters, histograms):
+    self.__mmaps, self.__mappedBytes = counters[:2]
+    self.__patterns = list(counters[2:])
+    (self.__readSizes, self.__readLatency, self.__writeSizes, self.__writeLatency,
+        self.__syncLatency) = histograms
+
+  def __access(self, offset, amount):
+    if offset is None:
+      offset = self.__position
+      self.__position += amount
+    if self.__lastEnd is not None:
+      if offset == self.__lastEnd:
+        self.__patterns[self.SEQUENTIAL] += 1
+      elif offset - self.__lastOffset == self.__lastStride:
+        self.__patterns[self.STRIDED] += 1
+      else:
+        self.__patterns[self.RANDOM] += 1
+      self.__lastStride = offset - self.__lastOffset
+    self.__lastOffset = offset
+    self.__lastEnd = offset + amount
 
-  def read(self, amount, time):
-    if self.__readLog.has_key(amount):
-      self.__readLog[amount] += 1
+  def seek(self, position):
+    self.__position = position
+    self.__seeked = True
+
+  def write(self, amount, time, offset=None):
+    self.__writeSizes.add(amount)
+    self.__writeLatency.add(toMicroseconds(time))
+    if offset is None and self.__append:
+      offset = self.__lastEnd or 0 # Always at the end
+    self.__access(offset, amount)
+
+  def read(self, amount, time, offset=None):
+    self.__readSizes.add(amount)
+    self.__readLatency.add(toMicroseconds(time))
+    self.__access(offset, amount)
+
+  def sync(self, time):
+    self.__syncLatency.add(toMicroseconds(time))
+
+  def mmap(self, length):
+    self.__mmaps += 1
+    self.__mappedBytes += length
+
+  def merge(self, other):
+    """
+    Adds the statistics of other, the same file seen later in the trace.
+    Positions of other are relative to ours unless it seeked, and the first
+    access after the merge starts a new pattern run.
+    """
+    for mine, theirs in zip((self.__readSizes, self.__readLatency, self.__writeSizes,
+        self.__writeLatency, self.__syncLatency), (other.__readSizes, other.__readLatency,
+        other.__writeSizes, other.__writeLatency, other.__syncLatency)):
+      mine.merge(theirs)
+    self.__patterns = [mine + theirs for mine, theirs in zip(self.__patterns, other.__patterns)]
+    self.__mmaps += other.__mmaps
+    self.__mappedBytes += other.__mappedBytes
+    if other.__seeked:
+      self.__position = other.__position
+      self.__seeked = True
     else:
-      self.__readLog[amount] = 1
-    self.__readTime += time
+      self.__position += other.__position
+    self.__lastOffset = self.__lastEnd = self.__lastStride = None
+
+  def getPattern(self):
+    """
+    Returns the dominant access pattern name, None before two accesses.
+    """
+    total = sum(self.__patterns)
+    if not total:
+      return None
+    return ('sequential', 'random', 'strided')[self.__patterns.index(max(self.__patterns))]
+
+  def __logOperation(self, name, sizes, latency):
+    seconds = latency.getTotal() / 1000000.0
+    return """
+%s log (total time %.2fms, %s, %s/s):
+latency %s
+%s
+""" % (name.capitalize(), seconds * 1000, humanizeSize(sizes.getTotal()),
+    humanizeSize(sizes.getTotal() / max(seconds, 1e-6)), latency.describe(),
+    '\n'.join(['%d %s%s of %s bytes' % (qty, name, qty != 1 and 's' or '',
+        low if low == high else '%d-%d' % (low, high)) for low, high, qty in sizes.getBuckets()]))
 
   def log(self):
-    if not self.__writeLog and not self.__readLog:
+    if not self.__writeSizes.getCount() and not self.__readSizes.getCount() \
+        and not self.__syncLatency.getCount() and not self.__mmaps:
       return
 
     retStr = """Filename: %s""" % self.__filename
-    if self.__writeLog:
+    if self.__writeSizes.getCount():
+      retStr += self.__logOperation('write', self.__writeSizes, self.__writeLatency)
+    if self.__readSizes.getCount():
+      retStr += self.__logOperation('read', self.__readSizes, self.__readLatency)
+    total = sum(self.__patterns)
+    if total:
       retStr += """
-Write log (total time %.2fms):
-%s
-""" % (self.__writeTime * 1000,
-    '\n'.join(['%d write%s of %d bytes' % (qty, qty != 1 and 's' or '', bytes) for bytes, qty in self.__writeLog.iteritems()]))
-    if self.__readLog:
+Access pattern: %s (%s)
+""" % (self.getPattern(), ', '.join(['%.1f%% %s' % (qty * 100.0 / total, name) for name, qty in
+    zip(('sequential', 'random', 'strided'), self.__patterns)]))
+    syncs = self.__syncLatency.getCount()
+    if syncs:
       retStr += """
-Read log (total time %.2fms):
-%s
-""" % (self.__readTime * 1000,
-    '\n'.join(['%d read%s of %d bytes' % (qty, qty != 1 and 's' or '', bytes) for bytes, qty in self.__readLog.iteritems()]))
+Sync log: %d sync%s (total time %.2fms)
+latency %s
+""" % (syncs, syncs != 1 and 's' or '', self.__syncLatency.getTotal() / 1000.0,
+    self.__syncLatency.describe())
+    if self.__mmaps:
+      retStr += """
+Mmap log: %d mapping%s of %s
+""" % (self.__mmaps, self.__mmaps != 1 and 's' or '', humanizeSize(self.__mappedBytes))
     print retStr
 
 
+class FileFilter(object):
+  """
+  Include and exclude filename globs: a filename matches when it matches
+  any include, or there are none, and no exclude. The globs of each kind
+  are joined in a single regex.
+  """
+
+  def __init__(self, includes=(), excludes=()):
+    object.__init__(self)
+    self.__includes = list(includes)
+    self.__excludes = list(excludes)
+    self.__compile()
+
+  def __compile(self):
+    join = lambda globs: globs and re.compile('|'.join(['(?:%s)' % fnmatch.translate(glob)
+        for glob in globs])) or None
+    self.__includeRe, self.__excludeRe = join(self.__includes), join(self.__excludes)
+
+  def __getstate__(self):
+    # Compiled patterns do not pickle, the pool sends filters to workers
+    return self.__includes, self.__excludes
+
+  def __setstate__(self, state):
+    self.__includes, self.__excludes = state
+    self.__compile()
+
+  def matches(self, filename):
+    return (self.__includeRe is None or self.__includeRe.match(filename) is not None) \
+        and (self.__excludeRe is None or self.__excludeRe.match(filename) is None)
+
+
+class FdTable(dict):
+  """
+  The fd to File dict of a process, remembering the fds it released.
+  """
+
+  def __init__(self):
+    dict.__init__(self)
+    self.released = set()
+
+
+class Timeline(object):
+  """
+  Bytes read, bytes written and operations per time window of every file and
+  process. Windows are numbered from the epoch, so timelines of the same
+  width merge by adding them. Once the windows seen span more than
+  MAX_WINDOWS the width doubles, adding neighbour windows together, so a
+  multi-hour trace keeps at most MAX_WINDOWS windows per series.
+  """
+  MAX_WINDOWS = 1024
+
+  def __init__(self, width=1.0):
+    object.__init__(self)
+    self.__width = width
+    self.__first = None
+    self.__last = None
+    self.__series = dict()
+
+  def __widen(self):
+    self.__width *= 2
+    if self.__first is not None:
+      self.__first //= 2
+      self.__last //= 2
+    for key, series in self.__series.iteritems():
+      widened = dict()
+      for index, values in series.iteritems():
+        window = widened.get(index // 2)
+        if window is None:
+          widened[index // 2] = values
+        else:
+          for column, value in enumerate(values):
+            window[column] += value
+      self.__series[key] = widened
+
+  def __span(self, first, last):
+    if self.__first is None:
+      self.__first, self.__last = first, last
+    else:
+      self.__first, self.__last = min(self.__first, first), max(self.__last, last)
+    while self.__last - self.__first >= self.MAX_WINDOWS:
+      self.__widen()
+
+  def add(self, key, timestamp, readBytes, writtenBytes, ops=1):
+    """
+    Accounts operations at timestamp seconds to the key series, a File or a
+    pid.
+    """
+    index = int(timestamp // self.__width)
+    if self.__first is None or not self.__first <= index <= self.__last:
+      self.__span(index, index)
+      index = int(timestamp // self.__width)
+    series = self.__series.get(key)
+    if series is None:
+      series = self.__series[key] = dict()
+    window = series.get(index)
+    if window is None:
+      series[index] = [readBytes, writtenBytes, ops]
+    else:
+      window[0] += readBytes
+      window[1] += writtenBytes
+      window[2] += ops
+
+  def merge(self, other, keys=None):
+    """
+    Adds the other timeline, renaming its series through the keys dict, or
+    dropping them when renamed to None.
+    """
+    if other.__first is None:
+      return self
+    while self.__width < other.__width:
+      self.__widen()
+    while other.__width < self.__width:
+      other.__widen()
+    keys = keys or dict()
+    for key, otherSeries in other.__series.iteritems():
+      key = keys.get(key, key)
+      if key is None:
+        continue
+      series = self.__series.setdefault(key, dict())
+      for index, values in otherSeries.iteritems():
+        window = series.get(index)
+        if window is None:
+          series[index] = list(values)
+        else:
+          for column, value in enumerate(values):
+            window[column] += value
+    self.__span(other.__first, other.__last)
+    return self
+
+  def getWidth(self):
+    return self.__width
+
+  def getWindows(self):
+    """
+    Returns the first and last window indexes, None if nothing was added.
+    """
+    return self.__first, self.__last
+
+  def getSeries(self):
+    """
+    Returns the (kind, name, {index: [read, written, ops]}) series, those of
+    Files with the same filename added together.
+    """
+    merged = dict()
+    for key, series in self.__series.iteritems():
+      if isinstance(key, File):
+        name = ('file', key.getFilename())
+      else:
+        name = ('process', str(key))
+      windows = merged.setdefault(name, dict())
+      for index, values in series.iteritems():
+        window = windows.get(index)
+        if window is None:
+          windows[index] = list(values)
+        else:
+          for column, value in enumerate(values):
+            window[column] += value
+    return [(kind, name, windows) for (kind, name), windows in sorted(merged.iteritems())]
+
+
 class FileManager(object):
+  """
+  Tracks the files behind every fd of every traced process. Each process has
+  its own fd table, copied on fork and shared on clone with CLONE_FILES, and
+  the fds pointing to the same open file (dup, inheritance) share its File,
+  which is closed once the last of them is.
+
+  Threads are grouped through /proc when live. A partial manager parses a
+  chunk of a trace: the tables of unknown processes start empty and unknown
+  fds get placeholder Files, resolved when merged into the manager holding
+  the trace before the chunk. Given a Timeline, the transfers of matching
+  files are also accounted at the time set by setClock.
 
-  def __init__(self, filenamePattern=None):
+  Files not matching the FileFilter are filtered when opened: their fds all
+  share a single ignored File, never accounted nor reported. Placeholders
+  are always kept, their process totals deferred until resolved.
+  """
+
+  def __init__(self, fileFilter=None, live=True, partial=False, timeline=None):
     object.__init__(self)
-    self.__activeFiles = {
-        0: File('<stdin>'),
-        1: File('<stdout>'),
-        2: File('<stderr>')
-      }
+    self.__live = live
+    self.__partial = partial
+    self.__fdTables = dict()
+    self.__references = dict()
+    self.__processes = dict()
+    self.__syscalls = dict()
     self.__closedFiles = []
-    self.__filenameRe = filenamePattern and re.compile(fnmatch.translate(filenamePattern)) or None
+    self.__placeholders = dict()
+    self.__parents = dict()
+    self.__exited = []
+    self.__fileFilter = fileFilter or FileFilter()
+    self.__ignored = File('<ignored>')
+    self.__deferred = dict()
+    self.__timeline = timeline
+    self.__clock = None
+
+  def __newFile(self, filename, append=False):
+    if self.__fileFilter.matches(filename):
+      return File(filename, append)
+    return self.__ignored
+
+  def __install(self, table, fd, file):
+    if table.get(fd) is file:
+      return
+    self.__release(table, fd)
+    table[fd] = file
+    if file is not self.__ignored:
+      self.__references[file] = self.__references.get(file, 0) + 1
+
+  def __release(self, table, fd):
+    file = table.pop(fd, None)
+    if file is None:
+      return False
+    table.released.add(fd)
+    if file is self.__ignored:
+      return True
+    self.__references[file] -= 1
+    if not self.__references[file]:
+      del self.__references[file]
+      self.__closedFiles.append(file)
+    return True
+
+  def __threadGroup(self, pid):
+    # Threads of attached processes show up without the clone creating them
+    if not self.__live:
+      return pid
+    try:
+      with open('/proc/%d/status' % pid) as fd:
+        for line in fd:
+          if line.startswith('Tgid:'):
+            return int(line.split()[1])
+    except (IOError, ValueError):
+      pass
+    return pid
+
+  def __getTable(self, pid):
+    table = self.__fdTables.get(pid)
+    if table is None:
+      tgid = pid and self.__threadGroup(pid)
+      if tgid != pid:
+        table = self.__getTable(tgid)
+      else:
+        table = FdTable()
+        for fd, filename in enumerate(('<stdin>', '<stdout>', '<stderr>')[:not self.__partial and 3 or 0]):
+          self.__install(table, fd, self.__newFile(filename))
+      self.__fdTables[pid] = table
+      self.__processes.setdefault(pid, [0, 0, 0, 0])
+    return table
+
+  def __getFile(self, pid, fd):
+    table = self.__getTable(pid)
+    file = table.get(fd)
+    if file is None:
+      logging.debug('Unknown fd %d of process %d, opened before tracing', fd, pid)
+      if self.__partial and fd not in table.released:
+        file = File('<fd %d of %d>' % (fd, pid))
+        self.__placeholders[(pid, fd)] = file
+        self.__deferred[file] = dict()
+      else:
+        file = self.__newFile('<fd %d of %d>' % (fd, pid))
+      self.__install(table, fd, file)
+    return file
+
+  def __account(self, pid, file, readBytes, writtenBytes, ops, microseconds):
+    # Placeholders may resolve to an ignored file, their process is told apart
+    deferred = self.__deferred.get(file)
+    if deferred is None:
+      totals, key = self.__processes[pid], pid
+    else:
+      totals, key = deferred.setdefault(pid, [0, 0, 0, 0]), (pid, file)
+    totals[0] += readBytes
+    totals[1] += writtenBytes
+    totals[2] += ops
+    totals[3] += microseconds
+    if self.__timeline is not None and self.__clock is not None:
+      self.__timeline.add(file, self.__clock, readBytes, writtenBytes, ops)
+      self.__timeline.add(key, self.__clock, readBytes, writtenBytes, ops)
+
+  def setClock(self, timestamp):
+    """
+    Sets the time, in seconds, of the syscalls that follow.
+    """
+    self.__clock = timestamp
+
+  def getTimeline(self):
+    return self.__timeline
+
+  def hasProcess(self, pid):
+    return self.__fdTables.has_key(pid)
+
+  def fork(self, pid, child, shareFiles):
+    if self.__fdTables.has_key(child):
+      return # Already seen while the clone was unfinished
+    logging.debug('Process %d %s process %d', pid, shareFiles and 'cloned' or 'forked', child)
+    self.__parents[child] = (pid, shareFiles)
+    table = self.__getTable(pid)
+    if not shareFiles:
+      inherited = FdTable()
+      for fd, file in table.iteritems():
+        self.__install(inherited, fd, file)
+      table = inherited
+    self.__fdTables[child] = table
+    self.__processes.setdefault(child, [0, 0, 0, 0])
+
+  def exit(self, pid):
+    logging.debug('Process %d exited', pid)
+    self.__exited.append(pid)
+    self.__parents.pop(pid, None)
+    table = self.__fdTables.pop(pid, None)
+    if table is None or [other for other in self.__fdTables.itervalues() if other is table]:
+      return # Still used by other threads
+    for fd in table.keys():
+      self.__release(table, fd)
+
+  def open(self, pid, filename, fd, append=False):
+    logging.debug('Opened "%s" as fd %d of process %d', filename, fd, pid)
+    self.__install(self.__getTable(pid), fd, self.__newFile(filename, append))
 
-  def open(self, filename, fd):
-    logging.debug('Opened "%s" as fd %d' % (filename, fd))
-    self.__activeFiles[fd] = File(filename)
+  def dup(self, pid, fd, newFd):
+    logging.debug('Duplicated fd %d as %d in process %d', fd, newFd, pid)
+    if fd != newFd:
+      self.__install(self.__getTable(pid), newFd, self.__getFile(pid, fd))
 
-  def write(self, fd, amount, time):
-    logging.debug('Wrote %d bytes from fd %d' % (amount, fd))
-    self.__activeFiles[fd].write(amount, time)
+  def write(self, pid, fd, amount, time, offset=None):
+    logging.debug('Wrote %d bytes from fd %d of process %d', amount, fd, pid)
+    file = self.__getFile(pid, fd)
+    if file is not self.__ignored:
+      file.write(amount, time, offset)
+      self.__account(pid, file, 0, amount, 1, toMicroseconds(time))
 
-  def read(self, fd, amount, time):
-    logging.debug('Red %d bytes from fd %d' % (amount, fd))
-    self.__activeFiles[fd].read(amount, time)
+  def read(self, pid, fd, amount, time, offset=None):
+    logging.debug('Red %d bytes from fd %d of process %d', amount, fd, pid)
+    file = self.__getFile(pid, fd)
+    if file is not self.__ignored:
+      file.read(amount, time, offset)
+      self.__account(pid, file, amount, 0, 1, toMicroseconds(time))
 
-  def close(self, fd):
-    logging.debug('Closed fd %d' % (fd, ))
-    self.__closedFiles.append(self.__activeFiles.pop(fd))
+  def transfer(self, pid, inFd, outFd, amount, time, offset=None):
+    logging.debug('Sent %d bytes from fd %d to fd %d of process %d', amount, inFd, outFd, pid)
+    inFile, outFile = self.__getFile(pid, inFd), self.__getFile(pid, outFd)
+    counted = 0 # A single operation for both files
+    if inFile is not self.__ignored:
+      inFile.read(amount, time, offset)
+      self.__account(pid, inFile, amount, 0, 1, toMicroseconds(time))
+      counted = 1
+    if outFile is not self.__ignored:
+      outFile.write(amount, time)
+      self.__account(pid, outFile, 0, amount, 1 - counted, (1 - counted) * toMicroseconds(time))
+
+  def seek(self, pid, fd, position):
+    logging.debug('Seeked fd %d of process %d to %d', fd, pid, position)
+    file = self.__getFile(pid, fd)
+    if file is not self.__ignored:
+      file.seek(position)
+
+  def sync(self, pid, fd, time):
+    logging.debug('Synced fd %d of process %d', fd, pid)
+    file = self.__getFile(pid, fd)
+    if file is not self.__ignored:
+      file.sync(time)
+
+  def mmap(self, pid, fd, length):
+    logging.debug('Mapped %d bytes from fd %d of process %d', length, fd, pid)
+    file = self.__getFile(pid, fd)
+    if file is not self.__ignored:
+      file.mmap(length)
+
+  def close(self, pid, fd):
+    logging.debug('Closed fd %d of process %d', fd, pid)
+    table = self.__getTable(pid)
+    if not self.__release(table, fd):
+      logging.debug('Unknown fd %d of process %d, opened before tracing', fd, pid)
+      table.released.add(fd) # Maybe known by the manager it merges into
+
+  def __baseTable(self, pids, parents):
+    # The table before the chunk of processes first seen in it
+    for pid in pids:
+      if self.__fdTables.has_key(pid):
+        return self.__fdTables[pid]
+    parent, shareFiles = parents.get(pids[0], (None, False))
+    while parent is not None and not self.__fdTables.has_key(parent):
+      parent = parents.get(parent, (None, False))[0]
+    if parent is None:
+      return self.__getTable(pids[0])
+    if shareFiles:
+      return self.__fdTables[parent]
+    table = FdTable()
+    for fd, file in self.__fdTables[parent].iteritems():
+      self.__install(table, fd, file)
+    return table
+
+  def __resolve(self, pid, fd, parents):
+    # The file behind a placeholder, as a sequential parse would have found it
+    if self.__fdTables.has_key(pid):
+      return self.__getFile(pid, fd)
+    ancestor = parents.get(pid, (None, ))[0]
+    while ancestor is not None:
+      table = self.__fdTables.get(ancestor)
+      if table is not None:
+        if table.has_key(fd):
+          return table[fd]
+        break
+      ancestor = parents.get(ancestor, (None, ))[0]
+    file = self.__newFile('<fd %d of %d>' % (fd, pid))
+    if file is not self.__ignored:
+      self.__closedFiles.append(file) # Its process exited within the chunk
+    return file
+
+  def merge(self, other):
+    """
+    Merges a partial manager, which parsed the trace right after ours.
+    """
+    groups = dict()
+    for pid, otherTable in other.__fdTables.iteritems():
+      groups.setdefault(id(otherTable), (otherTable, []))[1].append(pid)
+    bases = [(otherTable, pids, self.__baseTable(pids, other.__parents))
+        for otherTable, pids in groups.itervalues()]
+    for otherTable, pids, table in bases:
+      for pid in pids:
+        self.__fdTables[pid] = table
+        self.__processes.setdefault(pid, [0, 0, 0, 0])
+
+    resolved = {other.__ignored: self.__ignored}
+    for (pid, fd), placeholder in other.__placeholders.iteritems():
+      file = resolved.get(placeholder) or self.__resolve(pid, fd, other.__parents)
+      if file is not self.__ignored:
+        file.merge(placeholder)
+      resolved[placeholder] = file
+
+    for pid in other.__exited:
+      if not other.__fdTables.has_key(pid):
+        self.exit(pid)
+
+    for otherTable, pids, table in bases:
+      for fd, file in otherTable.iteritems():
+        self.__install(table, fd, resolved.get(file, file))
+      for fd in otherTable.released:
+        if not otherTable.has_key(fd):
+          self.__release(table, fd)
+
+    self.__closedFiles.extend([file for file in other.__closedFiles if not resolved.has_key(file)])
+    for pid, totals in other.__processes.iteritems():
+      self.__processes[pid] = [mine + theirs for mine, theirs in
+          zip(self.__processes.get(pid, [0, 0, 0, 0]), totals)]
+    keys = dict()
+    for placeholder, deferred in other.__deferred.iteritems():
+      file = resolved[placeholder]
+      keys[placeholder] = file is not self.__ignored and file or None
+      for pid, totals in deferred.iteritems():
+        keys[(pid, placeholder)] = file is not self.__ignored and pid or None
+        if file is not self.__ignored:
+          self.__processes[pid] = [mine + theirs for mine, theirs in
+              zip(self.__processes.get(pid, [0, 0, 0, 0]), totals)]
+    if self.__timeline is not None and other.__timeline is not None:
+      self.__timeline.merge(other.__timeline, keys)
+    for name, (latency, sizes) in other.__syscalls.iteritems():
+      if self.__syscalls.has_key(name):
+        self.__syscalls[name][0].merge(latency)
+        self.__syscalls[name][1].merge(sizes)
+      else:
+        self.__syscalls[name] = (latency, sizes)
+
+  def syscall(self, name, time, amount=None):
+    """
+    Accounts a finished syscall latency, and its transferred bytes if any.
+    """
+    if not self.__syscalls.has_key(name):
+      self.__syscalls[name] = (Histogram(), Histogram())
+    latency, sizes = self.__syscalls[name]
+    latency.add(toMicroseconds(time))
+    if amount is not None:
+      sizes.add(amount)
+
+  def logSyscalls(self):
+    print '%-12s %8s %12s %12s %10s %10s %10s %10s' % ('Syscall', 'Calls', 'Bytes', 'Throughput',
+        'p50', 'p90', 'p99', 'Max')
+    for name, (latency, sizes) in sorted(self.__syscalls.iteritems(),
+        key=lambda item: (-item[1][0].getTotal(), item[0])):
+      seconds = latency.getTotal() / 1000000.0
+      transferred, throughput = '-', '-'
+      if sizes.getCount():
+        transferred = humanizeSize(sizes.getTotal())
+        throughput = humanizeSize(sizes.getTotal() / max(seconds, 1e-6)) + '/s'
+      print '%-12s %8d %12s %12s %10s %10s %10s %10s' % ((name, latency.getCount(),
+          transferred, throughput) + tuple([humanizeLatency(value) for value in (latency.getPercentile(50),
+              latency.getPercentile(90), latency.getPercentile(99), latency.getMax())]))
+
+  def logProcesses(self, top=None):
+    processes = sorted(self.__processes.iteritems(),
+        key=lambda item: (-item[1][0] - item[1][1], item[0]))
+    print '%8s %12s %12s %8s %10s' % ('Pid', 'Read', 'Written', 'Ops', 'Time(ms)')
+    for pid, (readBytes, writtenBytes, ops, opsTime) in processes[:top]:
+      print '%8d %12s %12s %8d %10.2f' % (pid, humanizeSize(readBytes),
+          humanizeSize(writtenBytes), ops, opsTime / 1000.0)
+
+  def getFiles(self):
+    """
+    Returns the closed and the open files, all matching the filter.
+    """
+    return self.__closedFiles + self.__references.keys()
+
+  def getProcesses(self):
+    return self.__processes
+
+  def getSyscalls(self):
+    return self.__syscalls
+
+  def restore(self, files, processes, syscalls):
+    """
+    Adds the matching files, as closed, and totals from a saved profile.
+    """
+    self.__closedFiles.extend([file for file in files if self.__fileFilter.matches(file.getFilename())])
+    self.__processes.update(processes)
+    self.__syscalls.update(syscalls)
+
+  def logTop(self, top, elapsed):
+    """
+    Prints the top files and processes by transferred bytes so far.
+    """
+    files = [(file.getTotals(), file) for file in self.getFiles()]
+    files.sort(key=lambda item: item[0][0] + item[0][1], reverse=True)
+    print '--- Top %d files after %.1fs ---' % (top, elapsed)
+    print '%12s %12s %8s %10s %10s  %s' % ('Read', 'Written', 'Ops', 'Time(ms)', 'p99', 'Filename')
+    for (readBytes, writtenBytes, ops, opsTime), file in files[:top]:
+      (_, readLatency), (_, writeLatency), _ = file.getHistograms()
+      latency = Histogram().merge(readLatency).merge(writeLatency)
+      print '%12s %12s %8d %10.2f %10s  %s' % (humanizeSize(readBytes),
+          humanizeSize(writtenBytes), ops, opsTime * 1000,
+          humanizeLatency(latency.getPercentile(99)), file.getFilename())
+    self.logProcesses(top)
+    sys.stdout.flush()
+
+  def logTree(self, depth=None):
+    """
+    Prints the files totals rolled up by directory, in a tree of the busiest
+    directories first, down to depth levels. Relative filenames hang from
+    ".", and those not being paths are left out.
+    """
+    root = [0, 0, 0, 0, Histogram(), dict()]
+    for file in self.getFiles():
+      filename = file.getFilename()
+      if filename.startswith('<'):
+        continue
+      (_, readLatency), (_, writeLatency), _ = file.getHistograms()
+      totals = file.getTotals()
+      names = filename.startswith('/') and ['/'] or ['.']
+      names.extend([name + '/' for name in filename.split('/')[:-1] if name])
+      node = root
+      for name in names[:depth]:
+        node = node[5].get(name) or node[5].setdefault(name, [0, 0, 0, 0, Histogram(), dict()])
+        for column, value in enumerate(totals):
+          node[column] += value
+        node[4].merge(readLatency).merge(writeLatency)
+
+    print '%12s %12s %8s %10s %10s  %s' % ('Read', 'Written', 'Ops', 'Time(ms)', 'p99', 'Directory')
+    pending = [(name, node, 0) for name, node in
+        sorted(root[5].iteritems(), key=lambda item: (item[1][0] + item[1][1], item[0]))]
+    while pending:
+      name, (readBytes, writtenBytes, ops, opsTime, latency, children), level = pending.pop()
+      print '%12s %12s %8d %10.2f %10s  %s%s' % (humanizeSize(readBytes), humanizeSize(writtenBytes),
+          ops, opsTime * 1000, humanizeLatency(latency.getPercentile(99)), '  ' * level, name)
+      pending.extend([(child, node, level + 1) for child, node in
+          sorted(children.iteritems(), key=lambda item: (item[1][0] + item[1][1], item[0]))])
 
   def logAll(self):
-    for file in self.__closedFiles:
-      if not self.__filenameRe or self.__filenameRe.match(file.getFilename()):
-        file.log()
-    for _, file in self.__activeFiles.iteritems():
-      if not self.__filenameRe or self.__filenameRe.match(file.getFilename()):
-        file.log()
+    for file in self.getFiles():
+      file.log()
+    print 'Per process totals:'
+    self.logProcesses()
+    print '\nPer syscall totals:'
+    self.logSyscalls()
 
 
-class MatchEvent(object):
-  _prog = None
+def quotedString(text, start):
+  """
+  Returns the strace quoted string at text[start] and the index after it.
+  The escaped quotes are skipped without any regex backtracking.
+  """
+  end = start
+  while True:
+    end = text.index('"', end + 1)
+    backslash = end - 1
+    while text[backslash] == '\\':
+      backslash -= 1
+    if (end - backslash) % 2:
+      return text[start + 1:end], end + 1 # Not escaped
 
-  def match(self, matchLine):
-    if self._prog is None:
-      return # No prog pattern to match
-    matchObj = self._prog.match(matchLine)
-    if matchObj is None:
-      logging.debug('Unable to match %s' % matchLine)
-      return # Not a match
 
-    self._match(matchObj)
+class MatchEvent(object):
+  """
+  Accounts a finished syscall given its pid, its arguments text, its result
+  text and its duration. The arguments are split on their fixed delimiters.
+  """
+  transfers = False # The result is an amount of bytes
 
-  def _match(self, matchObj):
+  def match(self, pid, args, result, time):
     raise NotImplementedError
 
 
 class OpenEvent(MatchEvent):
-  _prog = re.compile(r'\(\"([^\"]+)\", ([_|A-Z]+)(, \d+)?\)[ ]+= (-?\d+)[^\<]+\<([.\d]+)\>')
+  # open(filename, flags[, mode]) and openat(dirfd, filename, flags[, mode])
 
-  def _match(self, matchObj):
-    fd = int(matchObj.group(4))
+  def match(self, pid, args, result, time):
+    fd = int(result)
     if fd < 0:
       return # Some error in the open
-    fileManager.open(matchObj.group(1), fd)
+    filename, end = quotedString(args, args.index('"'))
+    fileManager.open(pid, filename, fd, 'O_APPEND' in args[end:])
 
 
 class IOEvent(MatchEvent):
-  _prog = re.compile(r'\((\d+), \"(.*)\"\.*, (\d+)\)[ ]+= (\d+)[^\<]+\<([.\d]+)\>')
-
-  def _getData(self, matchObj):
-    return (int(matchObj.group(1)),
-        int(matchObj.group(4)),
-        float(matchObj.group(5)))
+  # read(fd, buffer, count), readv(fd, iovec, count) and the write ones, the
+  # positional ones add an offset. The buffer is never looked at.
+  transfers = True
+  positional = False
 
 
 class WriteEvent(IOEvent):
 
-  def _match(self, matchObj):
-    data = self._getData(matchObj)
-    fileManager.write(data[0], data[1], data[2])
+  def match(self, pid, args, result, time):
+    if result.isdigit():
+      fileManager.write(pid, int(args[:args.index(',')]), int(result), time,
+          int(args[args.rindex(' ') + 1:]) if self.positional else None)
 
 
 class ReadEvent(IOEvent):
 
-  def _match(self, matchObj):
-    data = self._getData(matchObj)
-    fileManager.read(data[0], data[1], data[2])
+  def match(self, pid, args, result, time):
+    if result.isdigit():
+      fileManager.read(pid, int(args[:args.index(',')]), int(result), time,
+          int(args[args.rindex(' ') + 1:]) if self.positional else None)
+
+
+class PwriteEvent(WriteEvent):
+  positional = True
+
+
+class PreadEvent(ReadEvent):
+  positional = True
+
+
+class SendfileEvent(MatchEvent):
+  # sendfile(outFd, inFd, NULL or [offset] => [new offset], count)
+  transfers = True
+
+  def match(self, pid, args, result, time):
+    if result.isdigit():
+      outFd, inFd, offset, _ = args.split(', ')
+      fileManager.transfer(pid, int(inFd), int(outFd), int(result), time,
+          int(offset[1:offset.index(']')]) if offset[0] == '[' else None)
+
+
+class MmapEvent(MatchEvent):
+  # mmap(address, length, protection, flags, fd, offset), anonymous with fd -1
+
+  def match(self, pid, args, result, time):
+    _, length, _, _, fd, _ = args.split(', ')
+    if result.startswith('0x') and int(fd) >= 0:
+      fileManager.mmap(pid, int(fd), int(length))
+
+
+class SyncEvent(MatchEvent):
+  # fsync(fd), fdatasync(fd)
+
+  def match(self, pid, args, result, time):
+    if result == '0':
+      fileManager.sync(pid, int(args), time)
+
+
+class SeekEvent(MatchEvent):
+  # lseek(fd, offset, whence)
+
+  def match(self, pid, args, result, time):
+    if result.isdigit():
+      fileManager.seek(pid, int(args[:args.index(',')]), int(result))
 
 
 class CloseEvent(MatchEvent):
-  _prog = re.compile(r'\((\d+)\)')
 
-  def _match(self, matchObj):
-    fd = int(matchObj.group(1))
-    fileManager.close(fd)
+  def match(self, pid, args, result, time):
+    fileManager.close(pid, int(args))
+
+
+class DupEvent(MatchEvent):
+  # dup(fd), dup2(fd, newFd) and dup3(fd, newFd, flags)
+
+  def match(self, pid, args, result, time):
+    if result.isdigit():
+      fileManager.dup(pid, int(args.split(',', 1)[0]), int(result))
+
+
+class FcntlEvent(DupEvent):
+  # fcntl(fd, F_DUPFD, minFd) duplicates, the other commands are ignored
+
+  def match(self, pid, args, result, time):
+    if args.split(', ', 2)[1].startswith('F_DUPFD'):
+      DupEvent.match(self, pid, args, result, time)
+
+
+class ForkEvent(MatchEvent):
+
+  def match(self, pid, args, result, time):
+    if result.isdigit():
+      fileManager.fork(pid, int(result), 'CLONE_FILES' in args)
 
 
 class UnknownEvent(MatchEvent):
 
-  def match(self, matchLine):
-    logging.error('Invalid line: %s' % matchLine)
+  def match(self, pid, args, result, time):
+    logging.error('Invalid line: %s', args)
 
 
 syscallDict = {
     'open': OpenEvent(),
+    'openat': OpenEvent(),
     'write': WriteEvent(),
     'read': ReadEvent(),
-    'close': CloseEvent()
+    'pwrite64': PwriteEvent(),
+    'pread64': PreadEvent(),
+    'writev': WriteEvent(),
+    'readv': ReadEvent(),
+    'pwritev': PwriteEvent(),
+    'preadv': PreadEvent(),
+    'sendfile': SendfileEvent(),
+    'sendfile64': SendfileEvent(),
+    'mmap': MmapEvent(),
+    'mmap2': MmapEvent(),
+    'fsync': SyncEvent(),
+    'fdatasync': SyncEvent(),
+    'lseek': SeekEvent(),
+    'close': CloseEvent(),
+    'dup': DupEvent(),
+    'dup2': DupEvent(),
+    'dup3': DupEvent(),
+    'fcntl': FcntlEvent(),
+    'clone': ForkEvent(),
+    'clone3': ForkEvent(),
+    'fork': ForkEvent(),
+    'vfork': ForkEvent()
   }
 
 
-def profileIt(args):
-  params = ['strace'
-      , '-ffT'
-      , '-e', 'trace=open,close,read,write'] + args
-  logging.info('Running "%s"' % ' '.join(params))
+class TraceParser(object):
+  """
+  Dispatches the strace -f output lines to the syscall events of their
+  process, joining the <unfinished ...> and resumed halves of the syscalls
+  interrupted by other processes. The common "pid [timestamp] name(args) =
+  result <time>" lines take a single match, the other ones are split on their
+  fixed delimiters. Timestamps come from -ttt (seconds since the epoch) or -tt
+  and -t (time of day, a trace crossing midnight going on the next day).
+  The resumed halves whose start was not seen are kept as orphans, so the
+  chunks of a trace can be stitched.
+  """
+  _unfinished = '<unfinished ...>'
+  _call = r'(\w+)\((.*)\) += (\S+)[^<]*(?:<([.\d]+)>)?$'
+  _callProg = re.compile(_call)
+  _syscallProg = re.compile(r'(\d+) +(?:(\d[\d.:]*) +)?' + _call)
 
-  null = open('/dev/null', 'wb')
-  strace = subprocess.Popen(params, stdout=null, stderr=subprocess.PIPE)
+  def __init__(self):
+    object.__init__(self)
+    self.__unfinished = dict()
+    self.__orphans = []
+    self.__lines = 0
+    self.__unknownEvent = UnknownEvent()
+    self.__lastTime = self.__days = 0
 
-  _, stderr = strace.communicate()
-  if strace.returncode:
-    logging.error('strace ended abnormally with return code %d: %s' % (strace.returncode, stderr.strip()))
-    return 3
+  def getLines(self):
+    return self.__lines
 
-  unknownEvent = UnknownEvent()
+  def getUnfinished(self):
+    return self.__unfinished
 
-  prog = re.compile(r'([^\(]+)(\(.+)')
-  for line in stderr.splitlines():
-    matchObj = prog.match(line)
+  def getOrphans(self):
+    return self.__orphans
+
+  def addUnfinished(self, unfinished):
+    self.__unfinished.update(unfinished)
+
+  def __inherit(self, pid):
+    # A new process may trace syscalls before its parent's clone returns
+    for parent, line in self.__unfinished.iteritems():
+      if isinstance(syscallDict.get(line[:line.find('(')]), ForkEvent):
+        fileManager.fork(parent, pid, 'CLONE_FILES' in line)
+        return
+
+  def __parseTimestamp(self, timestamp):
+    """
+    Returns the seconds of a -ttt, -tt or -t timestamp, None if unreadable.
+    """
+    try:
+      if ':' not in timestamp:
+        return float(timestamp)
+      hours, minutes, seconds = timestamp.split(':')
+      seconds = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+      logging.debug('Unable to parse timestamp %s', timestamp)
+      return None
+    if seconds + 43200 < self.__lastTime:
+      self.__days += 1 # Past midnight
+    self.__lastTime = seconds
+    return self.__days * 86400 + seconds
+
+  def parse(self, line):
+    self.__lines += 1
+    matchObj = self._syscallProg.match(line)
+    if matchObj is not None: # The common finished syscall
+      pid, timestamp, syscall, args, result, time = matchObj.groups()
+      pid = int(pid)
+      if timestamp is not None:
+        self.__setClock(timestamp)
+    else:
+      matchObj = self.__parseSpecial(line)
+      if matchObj is None:
+        return
+      pid, syscall, args, result, time = matchObj
+
+    if not fileManager.hasProcess(pid):
+      self.__inherit(pid)
+    event = syscallDict.get(syscall)
+    if event is None:
+      self.__unknownEvent.match(pid, line, None, None)
+      return
+    if time is None:
+      return # Not traced with -T
+    time = float(time)
+    try:
+      event.match(pid, args, result, time)
+    except (ValueError, IndexError):
+      logging.debug('Unable to match %s', line)
+      return
+    fileManager.syscall(syscall, time,
+        int(result) if event.transfers and result.isdigit() else None)
+
+  def __setClock(self, timestamp):
+    timestamp = self.__parseTimestamp(timestamp)
+    if timestamp is not None:
+      fileManager.setClock(timestamp)
+
+  def __parseSpecial(self, line):
+    """
+    Handles the lines the common pattern misses: no pid or a [pid N] one,
+    signals, exits and the unfinished and resumed halves. Returns the pid,
+    syscall, arguments, result and duration of a finished syscall, or None.
+    """
+    original, pid = line, 0
+    if line[:1].isdigit() and line[:line.find(' ')].isdigit():
+      pid, _, line = line.partition(' ')
+      pid, line = int(pid), line.lstrip(' ')
+    elif line.startswith('[pid '):
+      end = line.index(']')
+      pid, line = int(line[5:end]), line[end + 2:]
+    if line[:1].isdigit():
+      timestamp, _, line = line.partition(' ')
+      self.__setClock(timestamp)
+      line = line.lstrip(' ')
+    if not line or line[0] == '-':
+      return None # Nothing or a signal
+    if line[0] == '+':
+      self.__unfinished.pop(pid, None)
+      fileManager.exit(pid)
+      return None
+    if line.endswith(self._unfinished):
+      self.__unfinished[pid] = line[:-len(self._unfinished)].rstrip()
+      return None
+    if line.startswith('<... '):
+      start = self.__unfinished.pop(pid, None)
+      if start is None:
+        logging.debug('Resumed without start: %s', line)
+        self.__orphans.append(original)
+        return None
+      line = line[line.index('resumed>') + 8:].lstrip(' ')
+      line = start + (start.endswith(',') and ' ' or '') + line
+    matchObj = self._callProg.match(line)
+    if matchObj is None:
+      return None # Not a syscall
+    return (pid,) + matchObj.groups()
+
+
+class PerfTraceParser(TraceParser):
+  """
+  Parses perf trace output, "time (duration ms): comm/tid name(arg: value,
+  ...) = result", by rewriting its lines into strace syntax: the events are
+  fed the same way whichever the tracer. Perf symbolic flags lose their O_,
+  CLONE_ and F_ prefixes, which are restored.
+  """
+  _lineProg = re.compile(r' *([.\d]+) \( *(?:([.\d]+) ms)? *\): .*?/(\d+) +(.*)$')
+  _argProg = re.compile(r', (?=\w+: )')
+  _prefixes = {'flags': 'O_', 'clone_flags': 'CLONE_', 'cmd': 'F_'}
+
+  def __translateArgs(self, args):
+    values = []
+    for arg in args and self._argProg.split(args) or ():
+      name, _, value = arg.partition(': ')
+      if name in ('filename', 'pathname') and not value.startswith('"'):
+        value = '"%s"' % value.replace('"', '\\"')
+      elif self._prefixes.has_key(name) and not value[:1].isdigit():
+        prefix = self._prefixes[name]
+        value = '|'.join([prefix + flag for flag in value.split('|')])
+      elif name == 'dfd' and value == 'CWD':
+        value = 'AT_FDCWD'
+      values.append(value)
+    return ', '.join(values)
+
+  def parse(self, line):
+    matchObj = self._lineProg.match(line)
     if matchObj is None:
-      continue # Not a match
-    
-    syscall = matchObj.group(1)
-    if syscallDict.has_key(syscall):
-      syscallDict[syscall].match(matchObj.group(2))
+      return # Not a syscall line
+    timestamp, duration, pid, line = matchObj.groups()
+    # Milliseconds since the trace started
+    pid = '%s %.6f' % (pid, float(timestamp) / 1000)
+    if line.startswith('... [continued]: '):
+      syscall = line[17:line.index('(')]
+      result = line[line.index(') = ') + 4:]
+      TraceParser.parse(self, '%s <... %s resumed>) = %s <%.6f>' % (pid, syscall, result,
+          float(duration or 0) / 1000))
+    elif line.endswith(') ...'):
+      paren = line.index('(')
+      TraceParser.parse(self, '%s %s(%s <unfinished ...>' % (pid, line[:paren],
+          self.__translateArgs(line[paren + 1:-5])))
     else:
-      unknownEvent.match(line)
+      paren, equal = line.index('('), line.rindex(') = ')
+      TraceParser.parse(self, '%s %s(%s) = %s <%.6f>' % (pid, line[:paren],
+          self.__translateArgs(line[paren + 1:equal]), line[equal + 4:], float(duration or 0) / 1000))
+
+
+class Backend(object):
+  """
+  A tracer run by profileIt: its command line, writing the trace to a fifo,
+  and the parser of its output. Interrupting it with SIGINT makes it stop,
+  detaching from the attached processes.
+  """
+  name = None
+
+  def getCommand(self, fifoName, args, pids):
+    raise NotImplementedError
+
+  def createParser(self):
+    return TraceParser()
+
+
+class StraceBackend(Backend):
+  # ptrace stops every traced syscall, expect a heavy overhead on I/O loads
+  name = 'strace'
+  # Syscalls missing in some architectures are marked with ?
+  syscalls = ['?' * (syscall not in ('close', 'read', 'write')) + syscall
+      for syscall in sorted(syscallDict)]
+
+  def getCommand(self, fifoName, args, pids):
+    params = ['strace'
+        , '-fTttt'
+        , '-o', fifoName
+        , '-e', 'trace=' + ','.join(self.syscalls)]
+    for pid in pids:
+      params.extend(['-p', str(pid)])
+    return params + args
+
+
+class PerfBackend(Backend):
+  # perf trace reads the syscalls from kernel buffers, without stopping them
+  name = 'perf'
+  syscalls = [syscall for syscall in sorted(syscallDict) if syscall not in ('mmap2', 'sendfile64')]
+
+  def getCommand(self, fifoName, args, pids):
+    params = ['perf', 'trace'
+        , '-o', fifoName
+        , '-e', ','.join(self.syscalls)]
+    if pids:
+      params.extend(['-p', ','.join(map(str, pids))])
+    return params + (args and ['--'] + args or [])
 
+  def createParser(self):
+    return PerfTraceParser()
+
+
+backendDict = {
+    'strace': StraceBackend(),
+    'perf': PerfBackend()
+  }
+
+
+def traceLines(fd, process, keepFd):
+  """
+  Yields the lines read from the non blocking fifo fd while process runs,
+  and empty lines while idle so the caller can do periodic work. keepFd,
+  our own write end, avoids a premature EOF before the tracer opens the fifo
+  and is closed once process ends, so the remaining lines are drained.
+  """
+  pending = ''
+  while True:
+    if keepFd is not None and process.poll() is not None:
+      os.close(keepFd)
+      keepFd = None
+    if not select.select([fd], [], [], 0.5)[0]:
+      yield ''
+      continue
+    try:
+      data = os.read(fd, 65536)
+    except OSError, e:
+      if e.errno == errno.EAGAIN:
+        continue
+      raise
+    if not data:
+      if keepFd is None:
+        break
+      continue
+    lines = (pending + data).split('\n')
+    pending = lines.pop()
+    for line in lines:
+      yield line
+  if pending:
+    yield pending
+
+
+def profileIt(args, pids=(), duration=None, reportInterval=None, top=10, backend=None):
+  """
+  Traces the args command, or attaches to the running pids, with backend
+  (strace by default) feeding the global fileManager. Tracing stops after
+  duration seconds (or on SIGINT), detaching from attached processes. Every
+  reportInterval seconds the top files so far are printed.
+  """
+  backend = backend or backendDict['strace']
+  tmpDir = tempfile.mkdtemp(prefix='ioprofiler')
+  try:
+    fifoName = os.path.join(tmpDir, 'trace')
+    os.mkfifo(fifoName)
+    params = backend.getCommand(fifoName, args, pids)
+    logging.info('Running "%s"' % ' '.join(params))
+
+    # The trace is parsed from the fifo as it comes, never held in memory
+    fifo = os.open(fifoName, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+      keepFd = os.open(fifoName, os.O_WRONLY)
+      null = open('/dev/null', 'wb')
+      errors = tempfile.TemporaryFile()
+      try:
+        # Without close_fds the tracee would hold the fifo ends too
+        tracer = subprocess.Popen(params, stdout=null, stderr=errors, close_fds=True)
+      except:
+        os.close(keepFd)
+        raise
+
+      # SIGINT makes the tracer detach, we keep draining until it is done
+      stop = lambda *_: tracer.poll() is None and os.kill(tracer.pid, signal.SIGINT)
+      previousHandler = signal.signal(signal.SIGINT, stop)
+      started = lastReport = time.time()
+
+      traceParser = backend.createParser()
+      try:
+        for line in traceLines(fifo, tracer, keepFd):
+          now = time.time()
+          if duration and now - started >= duration:
+            stop()
+            duration = None
+          if reportInterval and now - lastReport >= reportInterval:
+            fileManager.logTop(top, now - started)
+            lastReport = now
+
+          traceParser.parse(line)
+      finally:
+        signal.signal(signal.SIGINT, previousHandler)
+    finally:
+      os.close(fifo)
+  finally:
+    shutil.rmtree(tmpDir)
+  elapsed = max(time.time() - started, 1e-6)
+  logging.info('Parsed %d lines in %.2fs (%d lines/s)', traceParser.getLines(), elapsed,
+      traceParser.getLines() / elapsed)
+
+  tracer.wait()
+  if tracer.returncode:
+    errors.seek(0, os.SEEK_END)
+    errors.seek(max(0, errors.tell() - 4096))
+    logging.error('%s ended abnormally with return code %d: %s' % (backend.name, tracer.returncode, errors.read().strip()))
+    return 3
+
+  return 0
+
+
+# Trace files are parsed in chunks of this size by a process pool
+CHUNK_SIZE = 32 * 1024 * 1024
+PARSE_BLOCK = 1024 * 1024
+
+
+def parseChunk(args):
+  """
+  Pool worker: parses the lines starting in [start, stop) of traceFilename
+  into a partial FileManager. Returns it with the orphan resumed lines, the
+  still unfinished syscalls and the number of lines.
+  """
+  traceFilename, start, stop, fileFilter, window = args
+  global fileManager
+  fileManager = FileManager(fileFilter, live=False, partial=True,
+      timeline=window and Timeline(window))
+  traceParser = TraceParser()
+  with open(traceFilename, 'rb') as fd:
+    if start:
+      fd.seek(start - 1)
+      fd.readline() # The line crossing start belongs to the previous chunk
+    remaining = stop - fd.tell()
+    pending = ''
+    while remaining > 0:
+      data = fd.read(min(PARSE_BLOCK, remaining))
+      if not data:
+        break
+      remaining -= len(data)
+      if remaining <= 0 and not data.endswith('\n'):
+        data += fd.readline() # Up to the end of the line crossing stop
+      lines = (pending + data).split('\n')
+      pending = lines.pop()
+      for line in lines:
+        traceParser.parse(line)
+    if pending:
+      traceParser.parse(pending)
+  return fileManager, traceParser.getOrphans(), traceParser.getUnfinished(), traceParser.getLines()
+
+
+def parseTrace(traceFilename, jobs=None, fileFilter=None):
+  """
+  Parses an existing strace -fT output into the global fileManager, in
+  parallel chunks whose partial states are merged in order. The syscalls
+  cut by a chunk boundary are stitched back. Prints the parsing throughput.
+  """
+  timeline = fileManager.getTimeline()
+  started = time.time()
+  size = os.path.getsize(traceFilename)
+  jobs = jobs or multiprocessing.cpu_count()
+  chunks = min(max(jobs, size // CHUNK_SIZE), max(1, size // PARSE_BLOCK))
+  logging.info('Parsing "%s" in %d chunks with %d jobs' % (traceFilename, chunks, jobs))
+
+  traceParser = TraceParser()
+  lines = 0
+  if chunks == 1 or jobs == 1:
+    with open(traceFilename, 'rb') as fd:
+      for line in fd:
+        traceParser.parse(line.rstrip('\n'))
+    lines = traceParser.getLines()
+  else:
+    ranges = [(traceFilename, size * chunk // chunks, size * (chunk + 1) // chunks,
+        fileFilter, timeline and timeline.getWidth()) for chunk in xrange(chunks)]
+    pool = multiprocessing.Pool(jobs)
+    try:
+      for partial, orphans, unfinished, chunkLines in pool.imap(parseChunk, ranges):
+        for line in orphans:
+          traceParser.parse(line)
+        fileManager.merge(partial)
+        traceParser.addUnfinished(unfinished)
+        lines += chunkLines # Orphans included, not counted again when parsed here
+    finally:
+      pool.terminate()
+
+  elapsed = max(time.time() - started, 1e-6)
+  print 'Parsed %d lines in %.2fs (%d lines/s)\n' % (lines, elapsed, lines / elapsed)
+  return 0
+
+
+# Saved profiles: a header then named sections of little endian int64
+# columns, with fixed offsets so they can be read straight from a mmap. A
+# section without columns holds rows bytes instead.
+PROFILE_MAGIC = 'IOPROF\x00\x01'
+PROFILE_HEADER = struct.Struct('<8sI')
+SECTION_HEADER = struct.Struct('<16sII')
+
+
+def packSection(name, columns):
+  rows = columns and len(columns[0]) or 0
+  return SECTION_HEADER.pack(name, rows, len(columns)) \
+      + ''.join([struct.pack('<%dq' % rows, *column) for column in columns])
+
+
+def unpackSections(data):
+  """
+  Returns the columns of every section, or its bytes if it has none.
+  """
+  magic, count = PROFILE_HEADER.unpack_from(data, 0)
+  if magic != PROFILE_MAGIC:
+    raise ValueError('Not a saved profile')
+  sections, offset = dict(), PROFILE_HEADER.size
+  for _ in xrange(count):
+    name, rows, columns = SECTION_HEADER.unpack_from(data, offset)
+    offset += SECTION_HEADER.size
+    if not columns:
+      sections[name.rstrip('\x00')] = data[offset:offset + rows]
+      offset += rows
+      continue
+    fmt = '<%dq' % rows
+    sections[name.rstrip('\x00')] = [struct.unpack_from(fmt, data, offset + 8 * rows * column)
+        for column in xrange(columns)]
+    offset += 8 * rows * columns
+  return sections
+
+
+def saveProfile(fileManager, filename):
+  """
+  Saves the files, processes and syscalls of fileManager. Names are kept in
+  a strings section, histograms as rows of a shared buckets section.
+  """
+  strings, stringsSize, buckets = [], [0], ([], [])
+  def addString(text):
+    strings.append(text)
+    stringsSize[0] += len(text)
+    return stringsSize[0] - len(text), len(text)
+  def addHistograms(histograms):
+    row = []
+    for histogram in histograms:
+      counts, count, total, maximum = histogram.getState()
+      row.extend([count, total, maximum, len(buckets[0]), len(counts)])
+      for index, qty in sorted(counts.iteritems()):
+        buckets[0].append(index)
+        buckets[1].append(qty)
+    return row
+
+  files = []
+  for file in fileManager.getFiles():
+    counters, histograms = file.getState()
+    files.append(addString(file.getFilename()) + tuple(counters) + tuple(addHistograms(histograms)))
+  processes = [(pid, ) + tuple(totals) for pid, totals in sorted(fileManager.getProcesses().iteritems())]
+  syscalls = [addString(name) + tuple(addHistograms(histograms))
+      for name, histograms in sorted(fileManager.getSyscalls().iteritems())]
+
+  with open(filename, 'wb') as fd:
+    fd.write(PROFILE_HEADER.pack(PROFILE_MAGIC, 5))
+    for name, rows in (('files', files), ('processes', processes), ('syscalls', syscalls)):
+      fd.write(packSection(name, zip(*rows)))
+    fd.write(packSection('buckets', buckets))
+    blob = ''.join(strings)
+    fd.write(SECTION_HEADER.pack('strings', len(blob), 0) + blob)
+  logging.info('Saved profile "%s" with %d files' % (filename, len(files)))
+
+
+def loadProfile(filename, fileFilter=None):
+  """
+  Returns a FileManager with the profile saved in filename.
+  """
+  with open(filename, 'rb') as fd:
+    data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    sections = unpackSections(data)
+    strings, buckets = sections['strings'], sections['buckets']
+    def getString(offset, length):
+      return strings[offset:offset + length]
+    def getHistograms(row, first, count):
+      histograms = []
+      for column in xrange(first, first + 5 * count, 5):
+        histogram = Histogram()
+        total, start, size = row[column], row[column + 3], row[column + 4]
+        histogram.setState(dict(zip(buckets[0][start:start + size], buckets[1][start:start + size])),
+            total, row[column + 1], row[column + 2])
+        histograms.append(histogram)
+      return histograms
+
+    files = []
+    for row in zip(*sections['files']):
+      file = File(getString(row[0], row[1]))
+      file.setState(row[2:7], getHistograms(row, 7, 5))
+      files.append(file)
+    processes = dict([(row[0], list(row[1:])) for row in zip(*sections['processes'])])
+    syscalls = dict([(getString(row[0], row[1]), tuple(getHistograms(row, 2, 2)))
+        for row in zip(*sections['syscalls'])])
+  finally:
+    data.close()
+
+  fileManager = FileManager(fileFilter, live=False)
+  fileManager.restore(files, processes, syscalls)
+  return fileManager
+
+
+def diffProfiles(oldFilename, newFilename, fileFilter=None):
+  """
+  Prints, per filename, the bytes, operations and latency percentiles of two
+  saved profiles, the biggest changes first.
+  """
+  profiles = []
+  for filename in (oldFilename, newFilename):
+    byName = dict()
+    for file in loadProfile(filename, fileFilter).getFiles():
+      byName.setdefault(file.getFilename(), File(file.getFilename())).merge(file)
+    profiles.append(byName)
+
+  def describe(file):
+    if file is None:
+      return 0, 0, None
+    readBytes, writtenBytes, ops, _ = file.getTotals()
+    (_, readLatency), (_, writeLatency), _ = file.getHistograms()
+    return readBytes + writtenBytes, ops, Histogram().merge(readLatency).merge(writeLatency)
+  def change(old, new):
+    if not old:
+      return new and '   new' or '     -'
+    return '%+5.0f%%' % ((new - old) * 100.0 / old)
+  def latency(histogram, percent):
+    return histogram and histogram.getCount() and humanizeLatency(histogram.getPercentile(percent)) or '-'
+
+  rows = []
+  for filename in set(profiles[0]) | set(profiles[1]):
+    old, new = describe(profiles[0].get(filename)), describe(profiles[1].get(filename))
+    rows.append((abs(new[0] - old[0]), filename, old, new))
+  rows.sort(key=lambda row: (-row[0], row[1]))
+
+  print '%12s %12s %6s %8s %8s %6s %10s %10s %10s %10s  %s' % ('Bytes', '(new)', '', 'Ops', '(new)', '',
+      'p50', '(new)', 'p99', '(new)', 'Filename')
+  totals = [0, 0, 0, 0]
+  for _, filename, old, new in rows:
+    print '%12s %12s %6s %8d %8d %6s %10s %10s %10s %10s  %s' % (humanizeSize(old[0]),
+        humanizeSize(new[0]), change(old[0], new[0]), old[1], new[1], change(old[1], new[1]),
+        latency(old[2], 50), latency(new[2], 50), latency(old[2], 99), latency(new[2], 99), filename)
+    totals = [total + value for total, value in zip(totals, (old[0], new[0], old[1], new[1]))]
+  print '%12s %12s %6s %8d %8d %6s  Total' % (humanizeSize(totals[0]), humanizeSize(totals[1]),
+      change(totals[0], totals[1]), totals[2], totals[3], change(totals[2], totals[3]))
   return 0
 
 
+def writeTimelineCsv(timeline, filename):
+  """
+  Writes a row per non empty window of every file and process series.
+  """
+  width = timeline.getWidth()
+  with open(filename, 'w') as fd:
+    fd.write('kind,name,start,end,read_bytes,written_bytes,ops\n')
+    for kind, name, windows in timeline.getSeries():
+      name = '"%s"' % name.replace('"', '""')
+      for index in sorted(windows):
+        readBytes, writtenBytes, ops = windows[index]
+        fd.write('%s,%s,%.6f,%.6f,%d,%d,%d\n' % (kind, name, index * width,
+            (index + 1) * width, readBytes, writtenBytes, ops))
+
+
+# Self-contained page: the series are inlined as JSON and drawn as a
+# heatmap, a row per file or process and a column per window
+TIMELINE_HTML = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>ioprofiler timeline</title>
+<style>
+body { font: 12px sans-serif; margin: 1em; }
+canvas { display: block; margin-top: 8px; }
+#tip { position: fixed; background: #ffe; border: 1px solid #999; padding: 2px 4px; display: none; }
+</style></head><body>
+<div>Show <select id="kind"><option>file</option><option>process</option></select>
+<select id="metric"><option value="3">bytes</option><option value="0">read bytes</option>
+<option value="1">written bytes</option><option value="2">operations</option></select>
+<span id="info"></span></div>
+<canvas id="total" height="80"></canvas><canvas id="map"></canvas><div id="tip"></div>
+<script>
+var data = /*DATA*/;
+var LABEL = 300, ROW = 14, HEIGHT = 80;
+function value(cell, metric) { return !cell ? 0 : metric == 3 ? cell[0] + cell[1] : cell[metric]; }
+function human(amount) {
+  var units = ['B', 'KiB', 'MiB', 'GiB', 'TiB'], unit = 0;
+  while (amount >= 1024 && unit < units.length - 1) { amount /= 1024; unit++; }
+  return amount.toFixed(unit ? 1 : 0) + ' ' + units[unit];
+}
+function draw() {
+  var kind = document.getElementById('kind').value, metric = +document.getElementById('metric').value;
+  var rows = data.series.filter(function (row) { return row.kind == kind; });
+  rows.forEach(function (row) {
+    row.sum = 0;
+    for (var index in row.windows) row.sum += value(row.windows[index], metric);
+  });
+  rows.sort(function (a, b) { return b.sum - a.sum; });
+  rows = rows.slice(0, data.top);
+  var columns = data.last - data.first + 1, cell = Math.max(1, Math.floor((window.innerWidth - LABEL - 40) / columns));
+  var totals = [], top = 0;
+  for (var column = 0; column < columns; column++) {
+    totals[column] = 0;
+    rows.forEach(function (row) { totals[column] += value(row.windows[data.first + column], metric); });
+    top = Math.max(top, totals[column]);
+  }
+  var canvas = document.getElementById('total'), context = canvas.getContext('2d');
+  canvas.width = LABEL + columns * cell;
+  context.fillStyle = '#36c';
+  totals.forEach(function (total, column) {
+    var height = top ? total * HEIGHT / top : 0;
+    context.fillRect(LABEL + column * cell, HEIGHT - height, cell, height);
+  });
+  context.fillStyle = '#000';
+  context.fillText('Total, max ' + (metric == 2 ? top : human(top)) + ' per ' + data.width + 's', 0, 12);
+  canvas = document.getElementById('map');
+  context = canvas.getContext('2d');
+  canvas.width = LABEL + columns * cell;
+  canvas.height = rows.length * ROW;
+  var peak = Math.log(1 + Math.max.apply(null, rows.map(function (row) {
+    var peak = 0;
+    for (var index in row.windows) peak = Math.max(peak, value(row.windows[index], metric));
+    return peak;
+  }).concat([1])));
+  rows.forEach(function (row, line) {
+    context.fillStyle = '#000';
+    context.fillText(row.name.slice(-48), 0, line * ROW + 11);
+    for (var index in row.windows) {
+      var amount = value(row.windows[index], metric);
+      if (!amount) continue;
+      var heat = Math.log(1 + amount) / peak;
+      context.fillStyle = 'rgb(255,' + Math.round(255 * (1 - heat)) + ',' + Math.round(200 * (1 - heat)) + ')';
+      context.fillRect(LABEL + (index - data.first) * cell, line * ROW, cell, ROW - 1);
+    }
+  });
+  canvas.onmousemove = function (event) {
+    var box = canvas.getBoundingClientRect(), tip = document.getElementById('tip');
+    var row = rows[Math.floor((event.clientY - box.top) / ROW)];
+    var index = data.first + Math.floor((event.clientX - box.left - LABEL) / cell);
+    if (!row || index < data.first) { tip.style.display = 'none'; return; }
+    var values = row.windows[index] || [0, 0, 0];
+    tip.innerHTML = row.name + '<br>' + new Date(index * data.width * 1000).toISOString() +
+        '<br>read ' + human(values[0]) + ', written ' + human(values[1]) + ', ' + values[2] + ' ops';
+    tip.style.left = event.clientX + 12 + 'px';
+    tip.style.top = event.clientY + 12 + 'px';
+    tip.style.display = 'block';
+  };
+  canvas.onmouseout = function () { document.getElementById('tip').style.display = 'none'; };
+  document.getElementById('info').textContent = rows.length + ' busiest of ' +
+      data.series.filter(function (row) { return row.kind == kind; }).length + ', ' + columns + ' windows';
+}
+document.getElementById('kind').onchange = document.getElementById('metric').onchange = draw;
+window.onresize = draw;
+draw();
+</script></body></html>
+"""
+
+
+def writeTimelineHtml(timeline, filename, top=50):
+  """
+  Writes the timeline as a self-contained HTML heatmap of the top busiest
+  files and processes.
+  """
+  first, last = timeline.getWindows()
+  data = dict(width=timeline.getWidth(), first=first or 0, last=last or 0, top=top,
+      series=[dict(kind=kind, name=name, windows=windows)
+          for kind, name, windows in timeline.getSeries()])
+  with open(filename, 'w') as fd:
+    # No </script> can end the script early from within a filename
+    fd.write(TIMELINE_HTML.replace('/*DATA*/', json.dumps(data).replace('</', '<\\/')))
+
+
 # Main entry point
 if __name__ == '__main__':
-  usage = 'Usage: %prog [options]'
+  usage = 'Usage: %prog [options] [command [arg ...]]'
   parser = optparse.OptionParser(usage=usage)
   parser.add_option('-l', '--log_level', dest='logLevel', default='INFO',
       help='log level [INFO]')
   programName, _ = os.path.splitext(sys.argv[0])
   parser.add_option('-f', '--log_file', dest='logFile', default='%s.log' % programName,
       help='log file [%s.log]' % programName)
-  parser.add_option('-p', '--patternr', dest='filenamePattern', default=None,
-      help='profile only files with this filename pattern')
+  parser.add_option('-p', '--patternr', dest='includes', action='append', default=list(),
+      help='profile only files with this filename pattern (repeatable)')
+  parser.add_option('-x', '--exclude', dest='excludes', action='append', default=list(),
+      help='do not profile files with this filename pattern (repeatable)')
+  parser.add_option('--tree', dest='treeDepth', type='int', default=None,
+      help='roll up the files by directory down to this depth, 0 for all levels')
+  parser.add_option('-a', '--attach', dest='pids', action='append', type='int',
+      default=list(), help='attach to this running process id (repeatable)')
+  parser.add_option('-d', '--duration', dest='duration', type='float', default=None,
+      help='stop tracing after this many seconds [until exit or interrupted]')
+  parser.add_option('-r', '--report-interval', dest='reportInterval', type='float',
+      default=None, help='print the top files every this many seconds [5 when attaching]')
+  parser.add_option('-t', '--top', dest='top', type='int', default=10,
+      help='files shown in the periodic report [10]')
+  parser.add_option('-b', '--backend', dest='backend', default='strace',
+      choices=sorted(backendDict), help='tracer among %s [strace]' % ', '.join(sorted(backendDict)))
+  parser.add_option('--overhead', dest='overhead', action='store_true', default=False,
+      help='run the command untraced first to report the tracing overhead')
+  parser.add_option('--trace', dest='traceFilename', default=None,
+      help='profile this strace -fT output, -fTttt for timelines, instead of tracing')
+  parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+      help='processes parsing a --trace file [CPU count]')
+  parser.add_option('-s', '--save', dest='saveFilename', default=None,
+      help='save the profile to this file, for --load and --diff')
+  parser.add_option('--load', dest='loadFilename', default=None,
+      help='report a saved profile instead of tracing')
+  parser.add_option('--diff', dest='diffFilenames', nargs=2, default=None, metavar='OLD NEW',
+      help='compare two saved profiles per file')
+  parser.add_option('-w', '--window', dest='window', type='float', default=1.0,
+      help='initial timeline window in seconds, doubled to fit %d windows [1]' % Timeline.MAX_WINDOWS)
+  parser.add_option('--csv', dest='csvFilename', default=None,
+      help='export the per window I/O of every file and process to this CSV file')
+  parser.add_option('--html', dest='htmlFilename', default=None,
+      help='export the per window I/O as an HTML heatmap to this file')
   options, args = parser.parse_args()
 
+  if not args and not options.pids and not options.traceFilename \
+      and not options.loadFilename and not options.diffFilenames:
+    parser.print_help()
+    print '\nERROR: No command nor process to trace'
+    sys.exit(1)
+  if options.reportInterval is None and options.pids:
+    options.reportInterval = 5.0
+
   loggingFormat = '%(asctime)s %(levelname)s %(message)s'
   numericLevel = getattr(logging, options.logLevel.upper(), None)
   if not isinstance(numericLevel, int):
@@ -231,9 +1795,46 @@ if __name__ == '__main__':
   # Define logging
   logging.basicConfig(format=loggingFormat, level=numericLevel, filename=options.logFile, filemode='w')
 
-  fileManager = FileManager(options.filenamePattern)
-  retCode = profileIt(args)
+  fileFilter = FileFilter(options.includes, options.excludes)
+  if options.diffFilenames:
+    sys.exit(diffProfiles(options.diffFilenames[0], options.diffFilenames[1], fileFilter))
+  timeline = (options.csvFilename or options.htmlFilename) and Timeline(options.window) or None
+  if options.loadFilename:
+    fileManager = loadProfile(options.loadFilename, fileFilter)
+    retCode = 0
+  elif options.traceFilename:
+    fileManager = FileManager(fileFilter, live=False, timeline=timeline)
+    retCode = parseTrace(options.traceFilename, options.jobs, fileFilter)
+  else:
+    fileManager = FileManager(fileFilter, timeline=timeline)
+    backend = backendDict[options.backend]
+    untraced = None
+    if options.overhead and args:
+      untraced = time.time()
+      subprocess.call(args)
+      untraced = time.time() - untraced
+    elif options.overhead:
+      logging.warning('Overhead can only be measured running a command, not attaching')
+    traced = time.time()
+    retCode = profileIt(args, options.pids, options.duration, options.reportInterval,
+        options.top, backend)
+    traced = time.time() - traced
+    if untraced is not None:
+      print 'Backend %s overhead: %.2fs traced, %.2fs untraced (%.1fx)\n' % (backend.name,
+          traced, untraced, traced / max(untraced, 1e-6))
+  if options.saveFilename:
+    saveProfile(fileManager, options.saveFilename)
+  if fileManager.getTimeline() is not None:
+    if options.csvFilename:
+      writeTimelineCsv(fileManager.getTimeline(), options.csvFilename)
+    if options.htmlFilename:
+      writeTimelineHtml(fileManager.getTimeline(), options.htmlFilename)
+  elif timeline is not None:
+    logging.warning('Saved profiles have no timeline to export')
   fileManager.logAll()
+  if options.treeDepth is not None:
+    print '\nPer directory totals:'
+    fileManager.logTree(options.treeDepth or None)
 
   sys.exit(retCode)
 
@@ -1,11 +1,56 @@
 #!C:\Python27\python.exe
 
+import array
+import collections
+import cPickle
+import ctypes
+import ctypes.util
+import hashlib
+import itertools
+import json
+import mmap
 import multiprocessing
 import optparse
 import os
+import Queue
+import re
+import select
+import socket
+import SocketServer
+import sqlite3
+import struct
 import sys
+import threading
 import time
 
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+
+QUEUE_SIZE = 64
+BATCH_SIZE = 4 * 1024 * 1024
+FILE_COST = 16 * 1024
+SPLIT_SIZE = 32 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+INDEX_DIR = os.path.join(os.path.expanduser('~'), '.mgrep')
+INDEX_MAX_SIZE = 64 * 1024 * 1024
+INDEX_MAX_RUNS = 16
+SNIFF_SIZE = 8192
+IGNORE_FILES = frozenset(('.gitignore', '.ignore'))
+IGNORE_DIRS = frozenset(('.git', '.hg', '.svn'))
+CACHE_SIZE = 512
+OUTPUT_BLOCK = 64 * 1024
+POLL_INTERVAL = 2.0
+INOTIFY_MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+INOTIFY_CONTENT = 0x2 | 0x8
+SAMPLE_SIZE = 64 * 1024
+DENSE_LINES = 4
+
 
 def HumanizeQuantity(quantity, unit):
 	prefixes = ('', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi')
@@ -18,72 +63,1244 @@ def HumanizeQuantity(quantity, unit):
 	return '%.2f %s%s' % (quantity, prefix, unit)
 
 
+def countLines(buf, start, stop):
+	return sum(buf[pos:min(pos + BLOCK_SIZE, stop)].count('\n')
+			for pos in xrange(start, stop, BLOCK_SIZE))
+
+
+class Matcher(object):
+	"""
+	Compiled search patterns. find() locates the next candidate hit in a
+	buffer, matchLine() tells whether the line around it really matches.
+
+	Literals are AND-ed by default: the rarest one in the data, see plan(),
+	anchors the search and the others are checked on its lines. With anyOf
+	they are OR-ed through a single alternation, so the scan stays in the re
+	engine.
+	"""
+
+	def __init__(self, patterns, regex=False, ignoreCase=False, anyOf=False):
+		object.__init__(self)
+		self.__patterns = patterns
+		self.__ignoreCase = ignoreCase
+		self.__literals = not regex and not (anyOf and len(patterns) > 1)
+		self.__regexes = self.__anchorRe = None
+		self.__anchor = None
+		flags = ignoreCase and re.I or 0
+		if regex:
+			flags |= re.M
+			self.__regexes = [re.compile(pattern, flags) for pattern in patterns]
+			if anyOf:
+				self.__regexes = [re.compile('|'.join(['(?:%s)' % pattern
+						for pattern in patterns]), flags)]
+			self.__anchorRe = self.__regexes[0]
+		elif anyOf and len(patterns) > 1:
+			# Longest first, the alternation is tried left to right
+			self.__regexes = [re.compile('|'.join([re.escape(pattern) for pattern in
+					sorted(patterns, key=len, reverse=True)]), flags)]
+			self.__anchorRe = self.__regexes[0]
+		else:
+			if ignoreCase:
+				self.__patterns = [pattern.lower() for pattern in patterns]
+			self.__setAnchor(max(self.__patterns, key=len))
+
+	def __setAnchor(self, anchor):
+		if self.__ignoreCase:
+			self.__anchorRe = re.compile(re.escape(anchor), re.I)
+		else:
+			self.__anchor = anchor
+
+	def plan(self, buf, start, stop):
+		"""
+		Counts the hits of the patterns on the first SAMPLE_SIZE bytes of
+		[start, stop), anchors the literals on the one with the fewest, and
+		returns whether the anchor hits more than one line in DENSE_LINES: a
+		scan of every line is then cheaper than one per hit.
+		"""
+		sample = buf[start:min(stop, start + SAMPLE_SIZE)]
+		if self.__literals:
+			if self.__ignoreCase:
+				sample = sample.lower()
+			hits, _, anchor = min([(sample.count(pattern), -len(pattern), pattern)
+					for pattern in self.__patterns])
+			self.__setAnchor(anchor)
+		else:
+			hits = len(self.__anchorRe.findall(sample))
+		return hits * DENSE_LINES > sample.count('\n') + 1
+
+	def find(self, buf, pos, stop):
+		if self.__anchor is not None:
+			return buf.find(self.__anchor, pos, stop)
+		matchObj = self.__anchorRe.search(buf, pos, stop)
+		return matchObj is None and -1 or matchObj.start()
+
+	def matchLine(self, line):
+		if self.__regexes is not None:
+			return all((regex.search(line) for regex in self.__regexes))
+		if self.__anchorRe is not None:
+			line = line.lower()
+		return all((pattern in line for pattern in self.__patterns))
+
+
+def scanPiece(matcher, filename, ignorePreprocessor, start=0, stop=None,
+		skipBinary=False, maxCount=0):
+	"""
+	Scans the lines starting in the [start, stop) byte range of a file and
+	returns (matchs, size, newlines), line numbers being relative to the
+	range. newlines is only counted when the range is not the whole file.
+	With skipBinary, files with a NUL byte in their first SNIFF_SIZE bytes
+	are not scanned and matchs is None. With maxCount, the scan stops after
+	that many matches.
+	"""
+	try:
+		with open(filename, 'rb') as fd:
+			size = os.fstat(fd.fileno()).st_size
+			if size <= start:
+				return (list(), 0, 0)
+			buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+	except EnvironmentError, e:
+		# print 'ERROR processing "%s": %s' % (filename, str(e))
+		return (list(), 0, 0)
+	try:
+		return scanBuffer(matcher, buf, ignorePreprocessor, start, stop, skipBinary,
+				maxCount)
+	finally:
+		buf.close()
+
+
+def scanBuffer(matcher, buf, ignorePreprocessor, start=0, stop=None,
+		skipBinary=False, maxCount=0):
+	"""
+	scanPiece over an already loaded buffer (a str or a mmap).
+	"""
+	matchs = list()
+	size = len(buf)
+	if size <= start:
+		return (matchs, 0, 0)
+	if skipBinary and buf.find('\0', 0, min(size, SNIFF_SIZE)) != -1:
+		return (None, min(stop or size, size) - start, 0)
+
+	# Only the lines around the candidate hits are ever built
+	partial = start or (stop is not None and stop < size)
+	if start:
+		start = buf.find('\n', start - 1) + 1 or size
+	if stop is None or stop >= size:
+		stop = size
+	else:
+		stop = buf.find('\n', stop - 1) + 1 or size
+	if start < stop and matcher.plan(buf, start, stop):
+		matchs = scanLines(matcher, buf, ignorePreprocessor, start, stop, maxCount)
+		return (matchs, stop - start, partial and countLines(buf, start, stop) or 0)
+	lineno, counted = 1, start
+	pos = -1
+	if start < stop:
+		pos = matcher.find(buf, start, stop)
+	while pos != -1:
+		lineStart = buf.rfind('\n', start, pos) + 1 or start
+		end = buf.find('\n', pos, stop)
+		if end == -1:
+			end = stop
+		lineno += countLines(buf, counted, lineStart)
+		counted = lineStart
+		line = buf[lineStart:end]
+		if matcher.matchLine(line) and \
+				not (ignorePreprocessor and line.lstrip().startswith('#')):
+			matchs.append((lineno, line.strip()))
+			if len(matchs) == maxCount:
+				break
+		pos = end + 1 < stop and matcher.find(buf, end + 1, stop) or -1
+	newlines = partial and lineno - 1 + countLines(buf, counted, stop) or 0
+	return (matchs, stop - start, newlines)
+
+
+def scanLines(matcher, buf, ignorePreprocessor, start, stop, maxCount=0):
+	"""
+	Matches every line of [start, stop), split by blocks of about BLOCK_SIZE,
+	for anchors hitting most lines.
+	"""
+	matchs = list()
+	lineno = 1
+	while start < stop:
+		end = min(buf.find('\n', min(start + BLOCK_SIZE, stop) - 1) + 1 or stop, stop)
+		lines = buf[start:end].split('\n')
+		if not lines[-1]:
+			lines.pop() # The block ends with a newline
+		for line in lines:
+			if matcher.matchLine(line) and \
+					not (ignorePreprocessor and line.lstrip().startswith('#')):
+				matchs.append((lineno, line.strip()))
+				if len(matchs) == maxCount:
+					return matchs
+			lineno += 1
+		start = end
+	return matchs
+
+
 def grep(args):
 	patterns, filename, ignorePreprocessor = args
+	return (filename, scanPiece(Matcher(patterns), filename, ignorePreprocessor)[0])
+
+
+def initWorker(patterns, ignorePreprocessor, regex=False, ignoreCase=False,
+		anyOf=False, skipBinary=False, maxCount=0):
+	# Pool initializer, so the patterns are compiled once per worker, not per task
+	global workerArgs
+	workerArgs = (Matcher(patterns, regex, ignoreCase, anyOf), ignorePreprocessor,
+			skipBinary, maxCount)
+
+
+def scanBatch(batch):
+	matcher, ignorePreprocessor, skipBinary, maxCount = workerArgs
+	return [(filename, start) + scanPiece(matcher, filename, ignorePreprocessor,
+			start, stop, skipBinary, maxCount) for filename, start, stop in batch]
+
+
+def batches(filenames):
+	"""
+	Groups files into tasks of about BATCH_SIZE bytes, each file costing at
+	least FILE_COST, and splits files bigger than SPLIT_SIZE in byte ranges.
+	"""
+	batch, budget = list(), 0
+	for filename, size in filenames:
+		for start in xrange(0, max(size, 1), SPLIT_SIZE):
+			stop = start + SPLIT_SIZE < size and start + SPLIT_SIZE or None
+			batch.append((filename, start, stop))
+			budget += (stop or size) - start + FILE_COST
+			if budget >= BATCH_SIZE:
+				yield batch
+				batch, budget = list(), 0
+	if batch:
+		yield batch
+
+
+def schedule(work, jobs, initArgs):
+	"""
+	Yields the piece results of every batch, in order. The first batch is
+	scanned in-process and the pool is only started if more work follows,
+	sized from the CPU share of that first batch unless jobs is given.
+	"""
+	initWorker(*initArgs)
+	batch = next(work, None)
+	if batch is None:
+		return
+	wall, cpu = time.time(), sum(os.times()[:2])
+	results = scanBatch(batch)
+	wall, cpu = time.time() - wall, sum(os.times()[:2]) - cpu
+	for result in results:
+		yield result
+
+	batch = next(work, None)
+	if batch is None:
+		return
+	if not jobs:
+		jobs = multiprocessing.cpu_count()
+		if cpu < wall / 2:
+			jobs *= 2 # I/O bound, keep more reads in flight
+	pool = multiprocessing.Pool(jobs, initWorker, initArgs)
 	try:
-		with open(filename) as fd:
-			if ignorePreprocessor:
-				matchs = list()
-				for lineno, line in	enumerate(fd):
-					line = line.strip()
-					if line.startswith('#'):
-						continue
-					if all((pattern in line for pattern in patterns)):
-						matchs.append((lineno + 1, line))
-				return (filename, matchs)
-			else:
-				return (filename, [(lineno + 1, line.strip())	for lineno, line in
-					enumerate(fd) if all((pattern in line for pattern in patterns))])
-	except IOError, e:
-		# print 'ERROR processing "%s": %s' % (filename, str(e))
-		return (filename, list())
+		for results in pool.imap(scanBatch, itertools.chain((batch, ), work)):
+			for result in results:
+				yield result
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def rootKey(rootPath):
+	return hashlib.sha1(os.path.abspath(rootPath)).hexdigest()
+
+
+def trigrams(args):
+	filename, fingerprint = args
+	try:
+		if fingerprint[1] > INDEX_MAX_SIZE:
+			return (filename, fingerprint, None)
+		with open(filename, 'rb') as fd:
+			data = fd.read().lower()
+	except IOError:
+		return (filename, fingerprint, None)
+	if '\0' in data[:8192]:
+		return (filename, fingerprint, None)
+	keys = set(data[i:i + 3] for i in xrange(len(data) - 2))
+	return (filename, fingerprint,
+			array.array('I', sorted(trigramKey(key) for key in keys)))
+
+
+def trigramKey(key):
+	return struct.unpack('>I', '\0' + key)[0]
+
+
+class TrigramIndex(object):
+	"""
+	On-disk trigram index of a root path, backed by sqlite. Files are keyed by
+	their path relative to the root, whatever the current directory, and
+	re-indexed only when their (mtime, size, inode) fingerprint changes. The
+	stat results come from the walk: a directory whose mtime and fingerprints
+	match its stored signature is skipped without reading its rows. Stale ids
+	are dropped from the files table and filtered out of the postings until
+	the next compaction.
+	"""
+
+	def __init__(self, rootPath, indexDir=None):
+		object.__init__(self)
+		indexDir = indexDir or INDEX_DIR
+		if not os.path.isdir(indexDir):
+			os.makedirs(indexDir)
+		self.__rootPath = rootPath
+		self.__prefix = len(os.path.join(rootPath, ''))
+		self.__conn = sqlite3.connect(os.path.join(indexDir, '%s.db' % rootKey(rootPath)))
+		self.__conn.text_factory = str
+		# Without AUTOINCREMENT a re-indexed file may get the id of a deleted
+		# one, still in the postings until compaction, and without directories
+		# the paths may be relative to another current directory: rebuild
+		row = self.__conn.execute(
+				'SELECT sql FROM sqlite_master WHERE name = \'files\'').fetchone()
+		if row is not None and ('AUTOINCREMENT' not in row[0] or 'dir TEXT' not in row[0]):
+			self.__conn.executescript("""
+				DROP TABLE IF EXISTS files;
+				DROP TABLE IF EXISTS postings;
+				DROP TABLE IF EXISTS meta;
+				DROP TABLE IF EXISTS dirs;
+			""")
+		self.__conn.executescript("""
+			CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY AUTOINCREMENT,
+				path TEXT UNIQUE, dir TEXT, mtime REAL, size INTEGER, inode INTEGER,
+				indexed INTEGER);
+			CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+			CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, signature INTEGER);
+			CREATE TABLE IF NOT EXISTS postings (trigram INTEGER, ids BLOB);
+			CREATE INDEX IF NOT EXISTS postings_trigram ON postings (trigram);
+			CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER);
+		""")
+
+	def close(self):
+		self.__conn.close()
+
+	def update(self, filenames, stats, directories):
+		"""
+		Brings the index up to date for the given files, with their stat
+		results in stats, walked from the given directories.
+		"""
+		prefix = self.__prefix
+		walked = dict()
+		for filename in filenames:
+			st = stats.get(filename)
+			if st is not None:
+				relPath = filename[prefix:]
+				walked.setdefault(os.path.dirname(relPath), []).append(
+						(filename, relPath, (st.st_mtime, st.st_size, st.st_ino)))
+		signatures = dict(self.__conn.execute('SELECT path, signature FROM dirs'))
+		changed = list()
+		stale = list()
+		gone = list()
+		for path in directories:
+			relDir = path[prefix:]
+			try:
+				mtime = os.stat(path).st_mtime
+			except OSError:
+				continue
+			files = walked.get(relDir, ())
+			# Added, removed or renamed entries change the directory mtime, not
+			# the writes in place
+			signature = hash((mtime, tuple([(relPath, fingerprint)
+					for _, relPath, fingerprint in files])))
+			if signatures.get(relDir) == signature:
+				continue
+			changed.append((relDir, signature))
+			known = dict((row[0], row[1:]) for row in self.__conn.execute(
+					'SELECT path, mtime, size, inode FROM files WHERE dir = ?', (relDir, )))
+			for filename, relPath, fingerprint in files:
+				if known.pop(relPath, None) != fingerprint:
+					stale.append((filename, fingerprint))
+			gone.extend([(relPath, ) for relPath in known
+					if not os.path.exists(os.path.join(self.__rootPath, relPath))])
+		if not changed:
+			return
+
+		cursor = self.__conn.cursor()
+		cursor.executemany('DELETE FROM files WHERE path = ?',
+				gone + [(filename[prefix:], ) for filename, _ in stale])
+		if stale:
+			postings = dict()
+			pool = multiprocessing.Pool()
+			for filename, fingerprint, keys in pool.imap_unordered(trigrams, stale, 16):
+				relPath = filename[prefix:]
+				cursor.execute('INSERT INTO files (path, dir, mtime, size, inode, indexed) '
+						'VALUES (?, ?, ?, ?, ?, ?)', (relPath, os.path.dirname(relPath))
+						+ fingerprint + (keys is not None, ))
+				for key in keys or ():
+					postings.setdefault(key, array.array('I')).append(cursor.lastrowid)
+			pool.close()
+			cursor.executemany('INSERT INTO postings VALUES (?, ?)',
+					((key, buffer(ids.tostring())) for key, ids in postings.iteritems()))
+			cursor.execute('INSERT OR IGNORE INTO meta VALUES (\'runs\', 0)')
+			cursor.execute('UPDATE meta SET value = value + 1 WHERE name = \'runs\'')
+		cursor.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?)', changed)
+		self.__conn.commit()
+		if stale and cursor.execute('SELECT value FROM meta WHERE name = \'runs\'') \
+				.fetchone()[0] >= INDEX_MAX_RUNS:
+			self.compact()
+
+	def compact(self):
+		"""
+		Merges the postings of every update run into one row per trigram,
+		dropping ids of files that changed or no longer exist.
+		"""
+		cursor = self.__conn.cursor()
+		for table in ('files', 'dirs'):
+			gone = [(path, ) for path, in cursor.execute('SELECT path FROM %s' % table)
+					if not os.path.exists(os.path.join(self.__rootPath, path))]
+			cursor.executemany('DELETE FROM %s WHERE path = ?' % table, gone)
+		live = set(fileId for fileId, in cursor.execute('SELECT id FROM files'))
+		postings = dict()
+		for key, ids in cursor.execute('SELECT trigram, ids FROM postings'):
+			postings.setdefault(key, array.array('I')).fromstring(str(ids))
+		cursor.execute('DELETE FROM postings')
+		cursor.executemany('INSERT INTO postings VALUES (?, ?)',
+				((key, buffer(array.array('I', [fileId for fileId in ids if fileId in live]).tostring()))
+				for key, ids in postings.iteritems()))
+		cursor.execute('UPDATE meta SET value = 0 WHERE name = \'runs\'')
+		self.__conn.commit()
+		self.__conn.execute('VACUUM')
+
+	def lookup(self, key):
+		ids = array.array('I')
+		for blob, in self.__conn.execute('SELECT ids FROM postings WHERE trigram = ?', (key, )):
+			ids.fromstring(str(blob))
+		return set(ids)
+
+	def candidates(self, pattern):
+		"""
+		Returns the ids of the files that may contain pattern, or None when the
+		pattern is too short to narrow anything.
+		"""
+		pattern = pattern.lower()
+		candidates = None
+		for key in set(pattern[i:i + 3] for i in xrange(len(pattern) - 2)):
+			ids = self.lookup(trigramKey(key))
+			candidates = ids if candidates is None else candidates & ids
+		return candidates
+
+	def paths(self, ids):
+		"""
+		Returns the relative paths of the files of ids and of the files never
+		indexed, binary or too large.
+		"""
+		paths = set(path for path, in self.__conn.execute(
+				'SELECT path FROM files WHERE NOT indexed'))
+		ids = list(ids)
+		for start in xrange(0, len(ids), 512): # Below the sqlite variables limit
+			chunk = ids[start:start + 512]
+			paths.update(path for path, in self.__conn.execute(
+					'SELECT path FROM files WHERE id IN (%s)' % ', '.join('?' * len(chunk)),
+					chunk))
+		return paths
+
+	def search(self, patterns, filenames, stats, directories, anyOf=False):
+		"""
+		Returns, in the given order, the files that may contain every pattern
+		(or any of them with anyOf). stats and directories come from the walk.
+		"""
+		self.update(filenames, stats, directories)
+		candidates = None
+		for pattern in patterns:
+			ids = self.candidates(pattern)
+			if anyOf:
+				if ids is None:
+					candidates = None
+					break
+				candidates = (candidates or set()) | ids
+			elif ids is not None:
+				candidates = ids if candidates is None else candidates & ids
+		if candidates is None:
+			return [filename for filename in filenames if filename in stats]
+		paths = self.paths(candidates)
+		return [filename for filename in filenames if filename in stats and
+				filename[self.__prefix:] in paths]
+
+
+class ResultCache(object):
+	"""
+	Per-file results of a search, keyed by the root path, the patterns and
+	the matching options, and validated by (mtime, size) fingerprints. Only
+	the files seen by the last run are kept.
+	"""
+
+	def __init__(self, rootPath, patterns, options, cacheDir=None):
+		object.__init__(self)
+		cacheDir = cacheDir or INDEX_DIR
+		if not os.path.isdir(cacheDir):
+			os.makedirs(cacheDir)
+		key = hashlib.sha1(repr((patterns, options.regex, options.ignoreCase,
+				options.anyOf, options.ignorePreprocessor, options.skipBinary,
+				options.maxCount))).hexdigest()
+		self.__path = os.path.join(cacheDir, '%s-%s.results' % (rootKey(rootPath), key))
+		try:
+			with open(self.__path, 'rb') as fd:
+				self.__previous = cPickle.load(fd)
+		except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+			self.__previous = dict()
+		self.__fingerprints = dict()
+		self.__current = dict()
+
+	def lookup(self, filename):
+		"""
+		Returns the cached (matchs, size) of filename, or None if it changed.
+		"""
+		try:
+			st = os.stat(filename)
+		except OSError:
+			return None
+		fingerprint = self.__fingerprints[filename] = (st.st_mtime, st.st_size)
+		entry = self.__previous.get(filename)
+		if entry is not None and entry[0] == fingerprint:
+			return entry[1:]
+		return None
+
+	def add(self, filename, matchs, size):
+		"""
+		Records the results of a file, or of the next piece of a split one.
+		"""
+		if filename not in self.__fingerprints:
+			return
+		entry = self.__current.get(filename)
+		if entry is not None:
+			# An empty list is a piece without matchs, only None means binary
+			matchs = None if entry[1] is None or matchs is None else entry[1] + matchs
+			size += entry[2]
+		self.__current[filename] = (self.__fingerprints[filename], matchs, size)
+
+	def discard(self, filename):
+		self.__current.pop(filename, None)
+
+	def save(self):
+		temporary = '%s.%d' % (self.__path, os.getpid())
+		with open(temporary, 'wb') as fd:
+			cPickle.dump(self.__current, fd, cPickle.HIGHEST_PROTOCOL)
+		if os.name == 'nt' and os.path.exists(self.__path):
+			os.remove(self.__path)
+		os.rename(temporary, self.__path)
+
+
+def merge(walked, cached, results):
+	"""
+	Yields the cached results and the pieces of the scanned files, in walk
+	order.
+	"""
+	pending = next(results, None)
+	for filename, _ in walked:
+		if filename in cached:
+			matchs, size = cached[filename]
+			yield (filename, 0, matchs, size, 0)
+			continue
+		while pending is not None and pending[0] == filename:
+			yield pending
+			pending = next(results, None)
+
+
+def globRegex(pattern):
+	# fnmatch.translate lets * cross directories, gitignore globs do not
+	regex, i = list(), 0
+	while i < len(pattern):
+		char = pattern[i]
+		if pattern.startswith('**/', i):
+			regex.append('(?:.*/)?')
+			i += 2
+		elif pattern.startswith('**', i):
+			regex.append('.*')
+			i += 1
+		elif char == '*':
+			regex.append('[^/]*')
+		elif char == '?':
+			regex.append('[^/]')
+		elif char == '[' and pattern.find(']', i + 2) != -1:
+			end = pattern.find(']', i + 2)
+			regex.append('[%s]' % re.sub(r'^!', '^', pattern[i + 1:end].replace('\\', '\\\\')))
+			i = end
+		elif char == '\\' and i + 1 < len(pattern):
+			i += 1
+			regex.append(re.escape(pattern[i]))
+		else:
+			regex.append(re.escape(char))
+		i += 1
+	return ''.join(regex)
+
+
+class IgnoreRules(object):
+	"""
+	Rules of the .gitignore/.ignore files of a directory, chained to the rules
+	of its parents. Deeper files take precedence and, within a file, the last
+	matching rule wins.
+	"""
+
+	def __init__(self, parent, path, names):
+		object.__init__(self)
+		self.__parent = parent
+		self.__path = path
+		self.__rules = list()
+		for name in sorted(IGNORE_FILES & names):
+			try:
+				with open(os.path.join(path, name)) as fd:
+					for line in fd:
+						self.__addRule(line)
+			except IOError:
+				pass
+
+	def __addRule(self, line):
+		line = line.rstrip('\r\n')
+		if not line.strip() or line.startswith('#'):
+			return
+		negate = line.startswith('!')
+		if negate:
+			line = line[1:]
+		dirOnly = line.endswith('/')
+		line = line.rstrip('/')
+		anchored = '/' in line
+		regex = (not anchored and '(?:.*/)?' or '') + globRegex(line.lstrip('/')) + '$'
+		self.__rules.append((re.compile(regex), negate, dirOnly))
+
+	def ignored(self, path, isDir):
+		rules = self
+		while rules is not None:
+			relPath = path[len(rules.__path):].lstrip(os.sep).replace(os.sep, '/')
+			for regex, negate, dirOnly in reversed(rules.__rules):
+				if (isDir or not dirOnly) and regex.match(relPath):
+					return not negate
+			rules = rules.__parent
+		return False
+
+
+class Entry(object):
+	"""
+	os.DirEntry stand-in when scandir is not available.
+	"""
+
+	def __init__(self, root, name):
+		object.__init__(self)
+		self.name = name
+		self.path = os.path.join(root, name)
+
+	def is_dir(self):
+		return os.path.isdir(self.path)
+
+	def is_symlink(self):
+		return os.path.islink(self.path)
+
+	def stat(self):
+		return os.stat(self.path)
+
 
+def listDir(path):
+	if scandir is not None:
+		return list(scandir(path))
+	return [Entry(path, name) for name in os.listdir(path)]
 
-def mgrep(patterns, options, rootPath=None):
+
+def entryStat(entry):
+	try:
+		return entry.stat()
+	except OSError:
+		return None
+
+
+def entrySize(entry):
+	st = entryStat(entry)
+	return st.st_size if st is not None else 0
+
+
+def walk(rootPath, extensions, excludeDirs, recursive, useIgnores=True, skipped=None,
+		visited=None, stats=None):
+	"""
+	Yields (filename, size) in os.walk order. File type and size come from
+	the directory listing, and with useIgnores, .gitignore/.ignore matches
+	and VCS directories are skipped and accounted in the skipped dict. The
+	directories listed are appended to visited and the stat results of the
+	files yielded stored in stats by filename, if given.
+	"""
+	skipped = skipped is None and collections.defaultdict(lambda: [0, 0]) or skipped
+	stack = [(rootPath, None)]
+	while stack:
+		path, rules = stack.pop()
+		try:
+			entries = listDir(path)
+		except OSError:
+			continue
+		if visited is not None:
+			visited.append(path)
+		names = set(entry.name for entry in entries)
+		if useIgnores and IGNORE_FILES & names:
+			rules = IgnoreRules(rules, path, names)
+
+		dirs = list()
+		for entry in entries:
+			isDir = entry.is_dir()
+			if isDir and (not recursive or entry.is_symlink() or entry.name in excludeDirs):
+				continue
+			if useIgnores and (isDir and entry.name in IGNORE_DIRS or
+					rules is not None and rules.ignored(entry.path, isDir)):
+				skipped[isDir and 'ignored dirs' or 'ignored'][0] += 1
+				if not isDir:
+					skipped['ignored'][1] += entrySize(entry)
+			elif isDir:
+				dirs.append(entry.path)
+			elif not extensions or os.path.splitext(entry.name)[1] in extensions:
+				st = entryStat(entry)
+				if st is not None and stats is not None:
+					stats[entry.path] = st
+				yield (entry.path, st.st_size if st is not None else 0)
+		stack.extend([(dirPath, rules) for dirPath in reversed(dirs)])
+
+
+def produce(iterable, queue, stop):
+	# Runs in the walker thread, the bounded queue keeps memory flat
+	try:
+		for item in iterable:
+			if stop.is_set():
+				break
+			queue.put(item)
+	finally:
+		queue.put(None)
+
+
+def consume(queue):
+	while True:
+		item = queue.get()
+		if item is None:
+			return
+		yield item
+
+
+class Output(object):
+	"""
+	Writes matches as text, JSON lines or NUL separated records, in blocks of
+	OUTPUT_BLOCK bytes unless the stream is a terminal. In the machine
+	readable formats the header and summary go to the messages stream.
+	"""
+
+	def __init__(self, stream=None, outputFormat='text', messages=None):
+		object.__init__(self)
+		self.__stream = stream or sys.stdout
+		self.__format = outputFormat
+		self.__messages = outputFormat == 'text' and self.__stream or messages
+		self.__interactive = hasattr(self.__stream, 'isatty') and self.__stream.isatty()
+		self.__pending, self.__size = list(), 0
+
+	def match(self, filename, lineno, line):
+		if self.__format == 'json':
+			record = json.dumps(dict(file=filename.decode('utf-8', 'replace'), line=lineno,
+					text=line.decode('utf-8', 'replace'))) + '\n'
+		elif self.__format == 'null':
+			record = '%s\0%d\0%s\0' % (filename, lineno, line)
+		else:
+			record = '  %s(%d): %s\n' % (filename, lineno, line)
+		self.__pending.append(record)
+		self.__size += len(record)
+
+	def message(self, text):
+		if self.__messages is not None:
+			self.flush(True)
+			self.__messages.write(text + '\n')
+			self.__messages.flush()
+
+	def flush(self, force=False):
+		if self.__pending and (force or self.__interactive or self.__size >= OUTPUT_BLOCK):
+			self.__stream.write(''.join(self.__pending))
+			self.__stream.flush()
+			self.__pending, self.__size = list(), 0
+
+
+def describe(patterns, options, rootPath):
+	extensions = options.extensions
+	extStr = extensions and \
+			'%s' % ', '.join(['*%s' % e for e in extensions]) or 'all files'
+	recStr = options.recursive and 'recursively' or 'non-recursively'
+	return 'mgrep %s%s in %s, %s, "%s"' % (
+			(options.anyOf and ' | ' or ' & ').join(['"%s"' % pattern for pattern in patterns]),
+			''.join([flag for flag, enabled in ((' (regex)', options.regex),
+				(' (ignoring case)', options.ignoreCase)) if enabled]),
+			extStr, recStr, rootPath)
+
+
+def summarize(matchingLines, matchingFiles, totalFiles, totalTime, totalSize, skipped):
+	return '  Matching lines: %d    Matching files: %d' \
+			'    Total files searched: %d    Total time: %.2fs (%s)%s' % \
+			(matchingLines, matchingFiles, totalFiles, totalTime,
+					HumanizeQuantity(totalSize / totalTime, 'B/s'),
+					''.join(['    Skipped %s: %d%s' % (reason, count,
+						reason != 'ignored dirs' and ' (%s)' % HumanizeQuantity(size, 'B') or '')
+						for reason, (count, size) in sorted(skipped.iteritems())]))
+
+
+def mgrep(patterns, options, rootPath=None, stream=None, messages=None):
+	"""
+	Searches rootPath, writing the matches to stream (stdout) and the header
+	and summary to messages (stdout in text format, stderr otherwise).
+	Returns the summary figures as a dict.
+	"""
 	extensions = options.extensions
 	excludeDirs = options.excludeDirs
 	recursive = options.recursive
 	ignorePreprocessor = options.ignorePreprocessor
+	maxCount, limit = options.maxCount, options.limit
 	rootPath = rootPath or '.'
 
-	extStr = extensions and \
-			'%s' % ', '.join(['*%s' % e for e in extensions]) or 'all files'
-	recStr = recursive and 'recursively' or 'non-recursively'
-	print 'mgrep %s in %s, %s, "%s"' % (' & '.join(['"%s"' % pattern for pattern in patterns]),
-			extStr, recStr, rootPath)
-
-	filenames = list()
-	for root, dirs, files in os.walk(rootPath):
-		if extensions:
-			filenames.extend([os.path.join(root, filename) for filename in files
-				if os.path.splitext(filename)[1] in extensions])
-		else:
-			filenames.extend([os.path.join(root, filename) for filename in files])
+	output = Output(stream or sys.stdout, options.outputFormat, messages or sys.stderr)
+	output.message(describe(patterns, options, rootPath))
 
-		if not recursive:
-			break
+	# Wall time, time.clock() is only CPU time on Linux
+	totalTime = time.time()
+	skipped = collections.defaultdict(lambda: [0, 0])
+	visited = stats = None
+	if options.index:
+		visited, stats = list(), dict()
+	filenames = walk(rootPath, extensions, excludeDirs, recursive,
+			options.useIgnores, skipped, visited, stats)
+	totalFiles = totalSize = 0
+	if options.index:
+		index = TrigramIndex(rootPath, options.indexDir)
+		sizes = collections.OrderedDict(filenames)
+		totalFiles = len(sizes)
+		# Regular expressions are not narrowed, only their candidates refreshed
+		filenames = [(filename, sizes[filename]) for filename in
+				index.search(not options.regex and patterns or [], sizes.keys(), stats,
+					visited, options.anyOf)]
+		totalFiles -= len(filenames)
+		index.close()
+	cache = None
+	if options.cache:
+		cache = ResultCache(rootPath, patterns, options, options.indexDir)
+		walked, cached = list(filenames), dict()
+		for filename, _ in walked:
+			entry = cache.lookup(filename)
+			if entry is not None:
+				cached[filename] = entry
+		filenames = [(filename, size) for filename, size in walked if filename not in cached]
 
-		map(dirs.remove, [eDir for eDir in excludeDirs if eDir in dirs])
+	queue = Queue.Queue(QUEUE_SIZE)
+	stop = threading.Event()
+	walker = threading.Thread(target=produce, args=(batches(filenames), queue, stop))
+	walker.daemon = True
+	walker.start()
 
-	totalSize = sum([os.stat(filename).st_size for filename in filenames])
-	totalTime = time.clock()
-	pool = multiprocessing.Pool()
 	resultDict = dict()
-	for result in pool.imap(grep, [(patterns, filename, ignorePreprocessor) for filename in filenames]):
-		filename, matchs = result
+	lineBase = matchingLines = 0
+	initArgs = (patterns, ignorePreprocessor, options.regex, options.ignoreCase,
+			options.anyOf, options.skipBinary, maxCount)
+	scanned = results = schedule(consume(queue), options.jobs, initArgs)
+	if cache is not None:
+		results = merge(walked, cached, scanned)
+	limited = False
+	for result in results:
+		filename, start, matchs, size, newlines = result
+		if matchs is None:
+			skipped['binary'][0] += not start
+			skipped['binary'][1] += size
+			if cache is not None:
+				cache.add(filename, None, size)
+			continue
+		if not start:
+			lineBase = 0
+			totalFiles += 1
+		matchs = [(lineBase + lineno, match) for lineno, match in matchs]
+		if maxCount:
+			matchs = matchs[:maxCount - resultDict.get(filename, 0)]
+		if cache is not None:
+			cache.add(filename, matchs, size)
+		if limit:
+			matchs = matchs[:limit - matchingLines]
 		for lineno, match in matchs:
-			print '  %s(%d): %s' % (filename, lineno, match)
+			output.match(filename, lineno, match)
+		output.flush()
 		if len(matchs):
-			resultDict[filename] = len(matchs)
-	totalTime = time.clock() - totalTime
+			resultDict[filename] = resultDict.get(filename, 0) + len(matchs)
+			matchingLines += len(matchs)
+		lineBase += newlines
+		totalSize += size
+		if limit and matchingLines >= limit:
+			if cache is not None:
+				cache.discard(filename) # May be only partially scanned
+			limited = True
+			break
 
-	print '  Matching lines: %d    Matching files: %d' \
-			'    Total files searched: %d    Total time: %.2fs (%s)' % \
-			(sum(resultDict.values()), len(resultDict), len(filenames), totalTime,
-					HumanizeQuantity(totalSize / totalTime, 'B/s'))
+	if limited:
+		# Cancels the pending pool work and unblocks the walker
+		results.close()
+		scanned.close()
+		stop.set()
+		while walker.is_alive():
+			try:
+				queue.get(timeout=0.1)
+			except Queue.Empty:
+				pass
+	walker.join()
+	totalTime = max(time.time() - totalTime, 1e-6)
+	if cache is not None:
+		cache.save()
 
+	output.message(summarize(matchingLines, len(resultDict), totalFiles, totalTime,
+			totalSize, skipped))
+	return dict(matchingLines=matchingLines, matchingFiles=len(resultDict),
+			totalFiles=totalFiles, totalSize=totalSize, totalTime=totalTime,
+			skipped=dict(skipped))
 
-if __name__ == '__main__':
+
+class ContentCache(object):
+	"""
+	LRU cache of file contents bounded by a byte budget.
+	"""
+
+	def __init__(self, budget):
+		object.__init__(self)
+		self.__budget = budget
+		self.__used = 0
+		self.__data = collections.OrderedDict()
+
+	def full(self):
+		return self.__used >= self.__budget
+
+	def discard(self, filename):
+		data = self.__data.pop(filename, None)
+		if data is not None:
+			self.__used -= len(data)
+
+	def get(self, filename, size):
+		"""
+		Returns the contents of filename, or None if it does not fit the budget.
+		"""
+		data = self.__data.pop(filename, None)
+		if data is None:
+			if size > self.__budget:
+				return None
+			try:
+				with open(filename, 'rb') as fd:
+					data = fd.read()
+			except IOError:
+				data = ''
+			if len(data) > self.__budget:
+				return None
+			self.__used += len(data)
+			while self.__used > self.__budget:
+				self.__used -= len(self.__data.popitem(last=False)[1])
+		self.__data[filename] = data
+		return data
+
+
+def serveShard(conn, budget):
+	"""
+	Search daemon worker, owning a shard of the files and their cache.
+	"""
+	cache = ContentCache(budget)
+	files = dict()
+	while True:
+		request = conn.recv()
+		command = request[0]
+		if command == 'update':
+			added, removed = request[1:]
+			for filename in removed:
+				files.pop(filename, None)
+				cache.discard(filename)
+			for filename, size in added.iteritems():
+				files[filename] = size
+				cache.discard(filename)
+		elif command == 'warm':
+			for filename in sorted(files):
+				if cache.full():
+					break
+				cache.get(filename, files[filename])
+		elif command == 'search':
+			initWorker(*request[1])
+			limit = request[2]
+			matcher, ignorePreprocessor, skipBinary, maxCount = workerArgs
+			results, scannedFiles, totalSize, matchingLines = list(), 0, 0, 0
+			# The output is sorted by path: with a limit, the first matching lines
+			# by path of every shard are enough
+			for filename, size in sorted(files.iteritems()) if limit else files.iteritems():
+				count = maxCount
+				if limit:
+					count = min(maxCount or limit, limit - matchingLines)
+				data = cache.get(filename, size)
+				if data is None:
+					result = scanPiece(matcher, filename, ignorePreprocessor, 0, None,
+							skipBinary, count)
+				else:
+					result = scanBuffer(matcher, data, ignorePreprocessor, 0, None,
+							skipBinary, count)
+				if result[0] is None or result[0]:
+					results.append((filename, result[0], result[1]))
+				scannedFiles += 1
+				totalSize += result[1]
+				if limit and result[0]:
+					matchingLines += len(result[0])
+					if matchingLines >= limit:
+						break
+			conn.send((results, scannedFiles, totalSize))
+		elif command == 'stop':
+			return
+
+
+class Inotify(object):
+	"""
+	Minimal ctypes binding of Linux inotify, raises OSError where missing.
+	"""
+
+	def __init__(self):
+		object.__init__(self)
+		try:
+			self.__libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+			self.fd = self.__libc.inotify_init()
+		except (AttributeError, TypeError):
+			raise OSError('inotify not available')
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init failed')
+		self.__watches = dict()
+
+	def add(self, path):
+		wd = self.__libc.inotify_add_watch(self.fd, path, INOTIFY_MASK)
+		if wd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for "%s"' % path)
+		self.__watches[wd] = path
+
+	def read(self, timeout=None):
+		"""
+		Returns the (path, mask) of the pending events, waiting up to timeout.
+		"""
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return list()
+		data, events, pos = os.read(self.fd, 65536), list(), 0
+		while pos < len(data):
+			wd, mask, _, length = struct.unpack_from('iIII', data, pos)
+			name = data[pos + 16:pos + 16 + length].rstrip('\0')
+			pos += 16 + length
+			if wd in self.__watches:
+				events.append((os.path.join(self.__watches[wd], name), mask))
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+
+class SearchServer(object):
+	"""
+	Keeps a warm view of a tree for repeated searches: the files are sharded
+	across worker processes, each one caching the contents of its shard in an
+	LRU bounded by its part of the memory budget. The tree is watched with
+	inotify (or polled every POLL_INTERVAL seconds where missing) so changed
+	files are dropped from the caches and new ones picked up.
+	"""
+
+	def __init__(self, rootPath, options):
+		object.__init__(self)
+		self.__rootPath = rootPath
+		self.__options = options
+		self.__lock = threading.Lock()
+		self.__files = dict()
+		self.__dirs = list()
+		jobs = options.jobs or multiprocessing.cpu_count()
+		budget = options.cacheSize * 1024 * 1024 // jobs
+		self.__shards = list()
+		for _ in xrange(jobs):
+			conn, child = multiprocessing.Pipe()
+			process = multiprocessing.Process(target=serveShard, args=(child, budget))
+			process.daemon = True
+			process.start()
+			self.__shards.append(conn)
+		self.rescan()
+		self.__broadcast(('warm', ))
+		watcher = threading.Thread(target=self.__watch)
+		watcher.daemon = True
+		watcher.start()
+
+	def __broadcast(self, request):
+		with self.__lock:
+			for conn in self.__shards:
+				conn.send(request)
+			if request[0] == 'search':
+				return [conn.recv() for conn in self.__shards]
+
+	def __update(self, added, removed):
+		updates = [(dict(), list()) for _ in self.__shards]
+		for filename, fingerprint in added.iteritems():
+			updates[hash(filename) % len(updates)][0][filename] = fingerprint[0]
+		for filename in removed:
+			updates[hash(filename) % len(updates)][1].append(filename)
+		with self.__lock:
+			for conn, update in zip(self.__shards, updates):
+				if update[0] or update[1]:
+					conn.send(('update', ) + update)
+
+	def rescan(self):
+		"""
+		Walks the tree again and sends the differences to the shards.
+		"""
+		options, files, dirs = self.__options, dict(), list()
+		for filename, size in walk(self.__rootPath, options.extensions,
+				options.excludeDirs, options.recursive, options.useIgnores, visited=dirs):
+			try:
+				files[filename] = (size, os.stat(filename).st_mtime)
+			except OSError:
+				pass
+		self.__update(dict((filename, fingerprint) for filename, fingerprint in
+				files.iteritems() if self.__files.get(filename) != fingerprint),
+				[filename for filename in self.__files if filename not in files])
+		self.__files, self.__dirs = files, dirs
+
+	def __poll(self):
+		while True:
+			time.sleep(POLL_INTERVAL)
+			self.rescan()
+
+	def __addWatches(self, inotify, watched):
+		"""
+		Watches the directories not watched yet, returns whether all are.
+		"""
+		complete = True
+		for path in self.__dirs:
+			if path not in watched:
+				try:
+					inotify.add(path)
+					watched.add(path)
+				except OSError:
+					complete = False # Usually out of watches, see fs.inotify.max_user_watches
+		return complete
+
+	def __watch(self):
+		try:
+			inotify = Inotify()
+		except OSError, e:
+			print 'mgrep polling "%s" every %gs: %s' % (self.__rootPath, POLL_INTERVAL, e)
+			self.__poll()
+
+		watched = set()
+		complete = self.__addWatches(inotify, watched)
+		if not watched and self.__dirs:
+			inotify.close()
+			print 'mgrep polling "%s" every %gs: no directory watched' % (self.__rootPath,
+					POLL_INTERVAL)
+			self.__poll()
+		reported = len(self.__dirs)
+		while True:
+			if not complete and len(watched) != reported:
+				reported = len(watched)
+				print 'mgrep watching %d of %d directories of "%s", rescanning every %gs' % (
+						len(watched), len(self.__dirs), self.__rootPath, POLL_INTERVAL)
+			# Directories without a watch are only seen by rescans
+			dirty, changed = not complete, dict()
+			events = inotify.read(not complete and POLL_INTERVAL or None)
+			while events:
+				for path, mask in events:
+					if mask & INOTIFY_CONTENT and path in self.__files:
+						changed[path] = self.__files[path]
+					elif not mask & INOTIFY_CONTENT:
+						dirty = True
+				# Drop stale contents now, structural changes once things settle
+				self.__update(changed, ())
+				changed = dict()
+				events = inotify.read(0.05)
+			if dirty:
+				self.rescan()
+				complete = self.__addWatches(inotify, watched)
+
+	def search(self, request, stream):
+		"""
+		Writes the results of a search request to stream, matches sorted by path.
+		"""
+		options = optparse.Values(self.__options.__dict__)
+		options._update_loose(request)
+		patterns = [pattern.encode('utf-8') for pattern in request['patterns']]
+		output = Output(stream, options.outputFormat)
+		output.message(describe(patterns, options, self.__rootPath))
+		totalTime = time.time()
+		initArgs = (patterns, options.ignorePreprocessor, options.regex,
+				options.ignoreCase, options.anyOf, options.skipBinary, options.maxCount)
+		try:
+			Matcher(*initArgs[:1] + initArgs[2:5])
+		except re.error, e:
+			stream.write('ERROR: invalid pattern: %s\n' % e)
+			return
+		replies = self.__broadcast(('search', initArgs, options.limit))
+		skipped = collections.defaultdict(lambda: [0, 0])
+		resultDict = dict()
+		matchingLines = totalFiles = totalSize = 0
+		for filename, matchs, size in sorted(itertools.chain(*[results for results, _, _ in replies])):
+			if matchs is None:
+				skipped['binary'][0] += 1
+				skipped['binary'][1] += size
+				continue
+			if options.limit:
+				matchs = matchs[:options.limit - matchingLines]
+			for lineno, match in matchs:
+				output.match(filename, lineno, match)
+			if matchs:
+				resultDict[filename] = len(matchs)
+				matchingLines += len(matchs)
+		output.flush(True)
+		for _, files, size in replies:
+			totalFiles += files
+			totalSize += size
+		# Not skipped['binary'], which adds "Skipped binary: 0" to every summary
+		binaryFiles, binarySize = skipped.get('binary', (0, 0))
+		totalFiles -= binaryFiles
+		totalSize -= binarySize
+		output.message(summarize(matchingLines, len(resultDict), totalFiles,
+				max(time.time() - totalTime, 1e-6), totalSize, skipped))
+
+	def stop(self):
+		self.__broadcast(('stop', ))
+
+
+class SearchRequestHandler(SocketServer.StreamRequestHandler):
+
+	def handle(self):
+		request = json.loads(self.rfile.readline())
+		self.server.searchServer.search(request, self.wfile)
+
+
+def socketPath(options, rootPath):
+	return options.socketPath or \
+			os.path.join(options.indexDir, '%s.sock' % rootKey(rootPath))
+
+
+def serve(options, rootPath):
+	path = socketPath(options, rootPath)
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	if os.path.exists(path):
+		os.remove(path)
+	searchServer = SearchServer(rootPath, options)
+	server = SocketServer.UnixStreamServer(path, SearchRequestHandler)
+	server.searchServer = searchServer
+	print 'mgrep serving "%s" on %s' % (rootPath, path)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		os.remove(path)
+		searchServer.stop()
+
+
+def client(patterns, options, rootPath):
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socketPath(options, rootPath))
+	except socket.error, e:
+		print 'ERROR: No mgrep server for "%s" (%s), start one with --serve' % (rootPath, e)
+		return 2
+	request = dict(patterns=patterns, ignorePreprocessor=options.ignorePreprocessor,
+			regex=options.regex, ignoreCase=options.ignoreCase, anyOf=options.anyOf,
+			skipBinary=options.skipBinary, maxCount=options.maxCount, limit=options.limit,
+			outputFormat=options.outputFormat)
+	sock.sendall(json.dumps(request) + '\n')
+	stream = sock.makefile('rb')
+	for line in stream:
+		sys.stdout.write(line)
+	sock.close()
+	return 0
+
+
+def createParser():
 	usage = 'Usage: %prog [options] <pattern> [pattern] ...'
 	parser = optparse.OptionParser(usage=usage)
 	parser.add_option('--ext', dest='extensions', action='append',
@@ -100,13 +1317,59 @@ if __name__ == '__main__':
 			action='store_true', default=False, help='filter by common extensions')
 	parser.add_option('--ignore-preprocessor', dest='ignorePreprocessor',
 			action='store_true', default=False, help='ignore preprocessor directives')
+	parser.add_option('--no-ignore', dest='useIgnores', action='store_false',
+			default=True, help='do not honour .gitignore/.ignore files nor skip VCS directories')
+	parser.add_option('--binary', dest='skipBinary', action='store_false',
+			default=True, help='search binary files too')
+	parser.add_option('-E', '--regex', dest='regex', action='store_true',
+			default=False, help='patterns are regular expressions')
+	parser.add_option('-i', '--ignore-case', dest='ignoreCase', action='store_true',
+			default=False, help='case insensitive matching')
+	parser.add_option('--any', dest='anyOf', action='store_true', default=False,
+			help='match lines with any of the patterns instead of all of them')
+	parser.add_option('--json', dest='outputFormat', action='store_const',
+			const='json', default='text', help='print matches as JSON lines')
+	parser.add_option('--null', dest='outputFormat', action='store_const',
+			const='null', help='print matches as NUL separated filename, line number and text')
+	parser.add_option('-m', '--max-count', dest='maxCount', type='int', default=0,
+			help='stop searching a file after this many matching lines')
+	parser.add_option('--limit', dest='limit', type='int', default=0,
+			help='stop the whole search after this many matching lines')
+	parser.add_option('-j', '--jobs', dest='jobs', type='int', default=0,
+			help='number of worker processes [guessed from cores and I/O]')
+	parser.add_option('--serve', dest='serve', action='store_true', default=False,
+			help='run a search daemon for the root path')
+	parser.add_option('--client', dest='client', action='store_true', default=False,
+			help='send the search to the daemon of the root path')
+	parser.add_option('--socket', dest='socketPath', default=None,
+			help='daemon Unix socket [<index dir>/<root hash>.sock]')
+	parser.add_option('--cache-size', dest='cacheSize', type='int', default=CACHE_SIZE,
+			help='daemon file contents cache, in MiB [%default]')
+	parser.add_option('--cache', dest='cache', action='store_true', default=False,
+			help='reuse the results of the previous identical search for unchanged files')
+	parser.add_option('--index', dest='index', action='store_true',
+			default=False, help='narrow the search with an incremental trigram index')
+	parser.add_option('--index-dir', dest='indexDir', default=INDEX_DIR,
+			help='directory to store trigram indexes [%default]')
+	return parser
+
+
+if __name__ == '__main__':
+	parser = createParser()
 	options, args = parser.parse_args()
 
-	if not len(args):
+	if not len(args) and not options.serve:
 		parser.print_help()
 		print '\nERROR: No pattern provided'
 		sys.exit(1)
 
+	# Literals always compile, a bad regex must fail before the workers start
+	if args and options.regex:
+		try:
+			Matcher(args, options.regex, options.ignoreCase, options.anyOf)
+		except re.error, e:
+			parser.error('invalid pattern: %s' % e)
+
 	if options.rootPath:
 		rootPath = options.rootPath
 	elif options.solution:
@@ -120,6 +1383,11 @@ if __name__ == '__main__':
 		defaultExtensions = '.cpp;.cxx;.cc;.c;.inl;.h;.hpp;.hxx;.hm'.split(';')
 		options.extensions = list(set(options.extensions + defaultExtensions))
 
-	mgrep(args, options, rootPath)
+	if options.serve:
+		serve(options, rootPath)
+	elif options.client:
+		sys.exit(client(args, options, rootPath))
+	else:
+		mgrep(args, options, rootPath)
 
 
@@ -0,0 +1,266 @@
+#!C:\Python27\python.exe
+
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+import mgrep
+
+
+NEEDLE = 'mgrepneedle'
+WORDS = ('int', 'return', 'static', 'const', 'void', 'char', 'struct', 'if',
+		'else', 'for', 'while', 'buffer', 'length', 'index', 'value', 'result',
+		'error', 'count', 'size_t', 'unsigned', 'pointer', 'node', 'list', 'next')
+DENSITIES = {'sparse': 100000, 'dense': 10}
+CHECK_SPLIT_SIZE = 64 * 1024
+MODES = {
+		'literal': ([NEEDLE], {}),
+		'and': (['return', NEEDLE], {}),
+		'ignorecase': ([NEEDLE.upper()], {'ignoreCase': True}),
+		'regex': ([r'mgrep\w+dle'], {'regex': True}),
+		'any': ([NEEDLE] + ['absentword%02d' % i for i in xrange(63)], {'anyOf': True}),
+	}
+
+
+def makeText(rng, size, density):
+	"""
+	Returns size bytes of C-like lines, one line in density holding NEEDLE.
+	"""
+	lines, total = list(), 0
+	while total < size:
+		words = [rng.choice(WORDS) for _ in xrange(rng.randint(3, 12))]
+		if not rng.randrange(density):
+			words.insert(rng.randrange(len(words)), NEEDLE)
+		line = '\t' * rng.randint(0, 3) + ' '.join(words) + ';\n'
+		lines.append(line)
+		total += len(line)
+	return ''.join(lines)[:size]
+
+
+def writeTiny(rng, root, scale, density):
+	# Many tiny files, the per-file and per-task overheads dominate
+	for i in xrange(int(20000 * scale)):
+		path = os.path.join(root, 'd%03d' % (i % 200))
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		with open(os.path.join(path, 'f%05d.h' % i), 'wb') as fd:
+			fd.write(makeText(rng, rng.randint(200, 2000), density))
+
+
+def writeHuge(rng, root, scale, density):
+	# A few huge files, split in byte ranges across the workers
+	block = makeText(rng, 1024 * 1024, density)
+	for i in xrange(3):
+		with open(os.path.join(root, 'huge%d.c' % i), 'wb') as fd:
+			for _ in xrange(max(1, int(64 * scale))):
+				fd.write(block)
+
+
+def writeDeep(rng, root, scale, density):
+	# Deep nesting, the walk dominates
+	path = root
+	for depth in xrange(32):
+		path = os.path.join(path, 'level%02d' % depth)
+		os.makedirs(path)
+		for i in xrange(max(1, int(20 * scale))):
+			with open(os.path.join(path, 'f%02d.c' % i), 'wb') as fd:
+				fd.write(makeText(rng, 8192, density))
+
+
+SHAPES = {'tiny': writeTiny, 'huge': writeHuge, 'deep': writeDeep}
+
+
+def makeCorpus(corpusDir, shape, density, scale, seed):
+	"""
+	Generates (once per shape, density, scale and seed) a reproducible tree.
+	"""
+	root = os.path.join(corpusDir, '%s-%s-%g-%d' % (shape, density, scale, seed))
+	stamp = os.path.join(root, '.complete')
+	if not os.path.exists(stamp):
+		if os.path.isdir(root):
+			shutil.rmtree(root)
+		os.makedirs(root)
+		SHAPES[shape](random.Random(seed), root, scale, DENSITIES[density])
+		open(stamp, 'wb').close()
+	return root
+
+
+def runOnce(root, patterns, args, conn):
+	"""
+	Child process body: runs a single search, reports its resource usage.
+	"""
+	options, _ = mgrep.createParser().parse_args(args)
+	devnull = open(os.devnull, 'wb')
+	cpu = os.times()
+	wall = time.time()
+	stats = mgrep.mgrep(patterns, options, root, devnull, devnull)
+	wall = time.time() - wall
+	cpu = [end - start for start, end in zip(cpu, os.times())]
+	peakRss = None
+	if resource is not None:
+		# KiB on Linux, pool workers are accounted once they are reaped
+		peakRss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+				resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+	conn.send(dict(wall=wall, cpu=sum(cpu[:4]), peakRssKiB=peakRss,
+			matches=stats['matchingLines'], files=stats['totalFiles'], bytes=stats['totalSize']))
+
+
+def check(root, patterns, args, indexDir):
+	"""
+	Returns whether --cache, cold then warm, finds the matches of a plain
+	run. Files are split in CHECK_SPLIT_SIZE pieces, most without matchs.
+	"""
+	plain = measure(root, patterns, args)
+	cacheArgs = args + ['--cache', '--index-dir', indexDir]
+	runs = [measure(root, patterns, cacheArgs) for _ in xrange(2)]
+	return all([(run['matches'], run['files']) == (plain['matches'], plain['files'])
+			for run in runs])
+
+
+def measure(root, patterns, args):
+	conn, child = multiprocessing.Pipe()
+	process = multiprocessing.Process(target=runOnce, args=(root, patterns, args, child))
+	process.start()
+	result = conn.recv()
+	process.join()
+	return result
+
+
+def benchmark(options):
+	corpusDir = options.corpusDir or tempfile.mkdtemp(prefix='mgrepbench')
+	results = list()
+	try:
+		for shape in options.shapes:
+			for density in options.densities:
+				root = makeCorpus(corpusDir, shape, density, options.scale, options.seed)
+				for mode in options.modes:
+					patterns, flags = MODES[mode]
+					for jobs in options.jobs:
+						args = ['-j', str(jobs)] + [flag for name, flag in
+								(('ignoreCase', '-i'), ('regex', '-E'), ('anyOf', '--any'))
+								if flags.get(name)]
+						measure(root, patterns, args) # Warms the page cache
+						runs = sorted([measure(root, patterns, args)
+								for _ in xrange(options.repeat)], key=lambda run: run['wall'])
+						run = runs[len(runs) // 2]
+						run.update(case='%s/%s' % (shape, density), mode=mode, jobs=jobs,
+								bytesPerSecond=run['bytes'] / run['wall'],
+								filesPerSecond=run['files'] / run['wall'])
+						print >> sys.stderr, '%-12s %-10s -j %-2d %8.3fs %8.3fs cpu %12s %10.0f files/s' % (
+								run['case'], mode, jobs, run['wall'], run['cpu'],
+								mgrep.HumanizeQuantity(run['bytesPerSecond'], 'B/s'),
+								run['filesPerSecond'])
+						results.append(run)
+	finally:
+		if not options.corpusDir:
+			shutil.rmtree(corpusDir)
+	return dict(python=platform.python_version(), platform=platform.platform(),
+			cpus=multiprocessing.cpu_count(), scale=options.scale, seed=options.seed,
+			repeat=options.repeat, results=results)
+
+
+def checkAll(options):
+	"""
+	Checks the cached results of every case, returns the number of failures.
+	"""
+	corpusDir = options.corpusDir or tempfile.mkdtemp(prefix='mgrepbench')
+	indexDir = tempfile.mkdtemp(prefix='mgrepcheck')
+	splitSize, mgrep.SPLIT_SIZE = mgrep.SPLIT_SIZE, CHECK_SPLIT_SIZE # Inherited by the runs
+	failures = 0
+	try:
+		for shape in options.shapes:
+			for density in options.densities:
+				root = makeCorpus(corpusDir, shape, density, options.scale, options.seed)
+				for mode in options.modes:
+					patterns, flags = MODES[mode]
+					args = [flag for name, flag in
+							(('ignoreCase', '-i'), ('regex', '-E'), ('anyOf', '--any'))
+							if flags.get(name)]
+					ok = check(root, patterns, args, indexDir)
+					failures += not ok
+					print >> sys.stderr, '%-12s %-10s %s' % ('%s/%s' % (shape, density), mode,
+							ok and 'ok' or 'CACHE MISMATCH')
+	finally:
+		mgrep.SPLIT_SIZE = splitSize
+		shutil.rmtree(indexDir)
+		if not options.corpusDir:
+			shutil.rmtree(corpusDir)
+	return failures
+
+
+def compare(baseline, report, tolerance):
+	"""
+	Prints the wall time ratio of every run against the baseline and returns
+	the number of runs slower than the tolerance allows.
+	"""
+	previous = dict(((run['case'], run['mode'], run['jobs']), run) for run in baseline['results'])
+	regressions = 0
+	for run in report['results']:
+		old = previous.get((run['case'], run['mode'], run['jobs']))
+		if old is None:
+			continue
+		ratio = run['wall'] / old['wall']
+		regressed = ratio > 1 + tolerance
+		regressions += regressed
+		print >> sys.stderr, '%-12s %-10s -j %-2d %6.2fx%s' % (run['case'], run['mode'],
+				run['jobs'], ratio, regressed and '  REGRESSION' or '')
+	return regressions
+
+
+if __name__ == '__main__':
+	usage = 'Usage: %prog [options]'
+	parser = optparse.OptionParser(usage=usage)
+	parser.add_option('--corpus-dir', dest='corpusDir', default=None,
+			help='directory to generate and keep the corpora [temporary]')
+	parser.add_option('--scale', dest='scale', type='float', default=1.0,
+			help='corpora size factor [%default]')
+	parser.add_option('--seed', dest='seed', type='int', default=7,
+			help='corpora random seed [%default]')
+	parser.add_option('--shape', dest='shapes', action='append', default=list(),
+			help='corpus shape among %s [all]' % ', '.join(sorted(SHAPES)))
+	parser.add_option('--density', dest='densities', action='append', default=list(),
+			help='match density among %s [all]' % ', '.join(sorted(DENSITIES)))
+	parser.add_option('--mode', dest='modes', action='append', default=list(),
+			help='search mode among %s [all]' % ', '.join(sorted(MODES)))
+	parser.add_option('-j', '--jobs', dest='jobs', default='1,0',
+			help='comma separated worker counts, 0 for automatic [%default]')
+	parser.add_option('--repeat', dest='repeat', type='int', default=3,
+			help='runs per measure, the median is reported [%default]')
+	parser.add_option('-o', '--output', dest='output', default=None,
+			help='JSON report filename [stdout]')
+	parser.add_option('--compare', dest='baseline', default=None,
+			help='JSON report to compare with, exits 1 on regressions')
+	parser.add_option('--tolerance', dest='tolerance', type='float', default=0.1,
+			help='wall time increase tolerated by --compare [%default]')
+	parser.add_option('--check', dest='check', action='store_true', default=False,
+			help='only check that --cache finds the same matches, on split files, exits 1 on mismatches')
+	options, args = parser.parse_args()
+
+	options.shapes = options.shapes or sorted(SHAPES)
+	options.densities = options.densities or sorted(DENSITIES)
+	options.modes = options.modes or sorted(MODES)
+	options.jobs = [int(jobs) for jobs in options.jobs.split(',')]
+
+	if options.check:
+		sys.exit(checkAll(options) and 1 or 0)
+
+	report = benchmark(options)
+	stream = options.output and open(options.output, 'w') or sys.stdout
+	json.dump(report, stream, indent=1, sort_keys=True)
+	stream.write('\n')
+
+	if options.baseline:
+		with open(options.baseline) as fd:
+			sys.exit(compare(json.load(fd), report, options.tolerance) and 1 or 0)
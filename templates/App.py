@@ -6,15 +6,20 @@ App classes to easy python development.
 
 # Imports externals
 import os
+import re
 import sys
-import yaml
+import time
+import marshal
+import atexit
 import logging
-import logging.handlers
 import optparse
-import simplejson
-import ConfigParser
+import __builtin__
 
 # Imports internals
+# The config format parsers (simplejson, ConfigParser and yaml) are imported
+# on first use: short-lived tools without config files never pay for them.
+# So are the modules of the opt-in features: async logging, config watching,
+# metrics and their JSON or Unix socket export
 
 
 class NullHandler(logging.Handler):
@@ -36,6 +41,865 @@ class NullHandler(logging.Handler):
 logging.getLogger().addHandler(NullHandler())
 
 
+class AsyncHandler(logging.Handler):
+  """
+  Logging handler queueing the records for a background thread, which
+  writes them through the target handler, so logging never waits for the
+  output. Records are taken in batches: stream handlers write a whole batch
+  before a single flush. When the bounded queue is full the records are
+  dropped and counted, or the caller blocks until there is room.
+
+  :param target: Handler writing the records, its level is used.
+  :type target: logging.Handler
+
+  :param capacity: Maximum number of queued records.
+  :type capacity: int
+
+  :param block: Whether to block instead of dropping when the queue is full.
+  :type block: bool
+
+  :param batchSize: Maximum number of records written per batch.
+  :type batchSize: int
+  """
+
+  def __init__(self, target, capacity=10000, block=False, batchSize=256):
+    logging.Handler.__init__(self, target.level)
+    self.__target = target
+    self.__formatter = target.formatter or logging.Formatter()
+    self.__block = block
+    self.__batchSize = batchSize
+    import Queue
+    import threading
+    self.__queue = Queue.Queue(capacity)
+    self.__empty, self.__full = Queue.Empty, Queue.Full
+    self.__dropped = 0
+    self.__droppedLock = threading.Lock()
+    self.__writer = threading.Thread(target=self.__write, name='AsyncHandler')
+    self.__writer.daemon = True
+    self.__writer.start()
+
+  def emit(self, record):
+    """
+    Overriden method. Queues the record, the message and traceback already
+    formatted as its arguments may change before being written.
+
+    :param record: Logging record to emit.
+    """
+    try:
+      if record.args:
+        record.msg, record.args = record.getMessage(), None
+      if record.exc_info:
+        record.exc_text = self.__formatter.formatException(record.exc_info)
+        record.exc_info = None
+      if self.__block:
+        self.__queue.put(record)
+      else:
+        self.__queue.put_nowait(record)
+    except self.__full:
+      with self.__droppedLock:
+        self.__dropped += 1
+    except (KeyboardInterrupt, SystemExit):
+      raise
+    except:
+      self.handleError(record)
+
+  def __write(self):
+    """
+    Writer thread body, until a None record is queued.
+    """
+    while True:
+      records = [self.__queue.get()]
+      try:
+        while len(records) < self.__batchSize:
+          records.append(self.__queue.get_nowait())
+      except self.__empty:
+        pass
+      try:
+        self.__writeBatch([record for record in records if record is not None])
+      finally:
+        for _ in records:
+          self.__queue.task_done()
+      if None in records:
+        return
+
+  def __writeBatch(self, records):
+    """
+    Method for write a batch of records through the target handler.
+    """
+    stream = getattr(self.__target, 'stream', None)
+    if stream is None:
+      for record in records:
+        self.__target.handle(record)
+      return
+    self.__target.acquire()
+    try:
+      for record in records:
+        try:
+          self.__writeRecord(stream, self.__target.format(record))
+        except (KeyboardInterrupt, SystemExit):
+          raise
+        except:
+          self.__target.handleError(record)
+      self.__target.flush()
+    finally:
+      self.__target.release()
+
+  @staticmethod
+  def __writeRecord(stream, msg):
+    """
+    Method for write a formatted record with the unicode fallbacks of
+    logging.StreamHandler, so the output is the same as without queue.
+    """
+    fs = '%s\n'
+    try:
+      if isinstance(msg, unicode) and getattr(stream, 'encoding', None):
+        ufs = u'%s\n'
+        try:
+          stream.write(ufs % msg)
+        except UnicodeEncodeError:
+          stream.write((ufs % msg).encode(stream.encoding))
+      else:
+        stream.write(fs % msg)
+    except UnicodeError:
+      stream.write(fs % msg.encode('UTF-8'))
+
+  def getDropped(self):
+    """
+    Returns the number of records dropped because the queue was full.
+
+    :rtype: int
+    """
+    return self.__dropped
+
+  def flush(self):
+    """
+    Overriden method. Waits until the queued records are written.
+    """
+    if self.__writer.isAlive():
+      self.__queue.join()
+
+  def close(self):
+    """
+    Overriden method. Writes the queued records and stops the writer.
+    """
+    if self.__writer.isAlive():
+      self.__queue.put(None) # Even with a full queue, never drops the stop
+      self.__writer.join()
+    self.__target.close()
+    logging.Handler.close(self)
+
+
+class ConfigWatcher(object):
+  """
+  Watches files from a background thread, calling back with the set of the
+  changed ones. Uses inotify through ctypes on Linux, watching the parent
+  directories so files replaced by a rename are seen, and polls the files
+  modification time, size and inode every interval seconds elsewhere.
+  Events are collected for a short quiet period, so a file written in
+  several steps is reported once.
+
+  :param filenames: Filenames to watch, they may not exist yet.
+  :type filenames: list
+
+  :param callback: Called with the set of changed filenames.
+  :type callback: callable
+
+  :param interval: Polling interval in seconds.
+  :type interval: float
+  """
+  # inotify(7) constants
+  IN_CLOSE_WRITE = 0x8
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_NONBLOCK = 0x800
+  IN_CLOEXEC = 0x80000
+  QUIET_PERIOD = 0.1
+
+  def __init__(self, filenames, callback, interval=1.0):
+    object.__init__(self)
+    self.__filenames = [os.path.abspath(filename) for filename in filenames]
+    self.__callback = callback
+    self.__interval = interval
+    import threading
+    self.__stopped = threading.Event()
+    self.__directories = {} # Watched directory of every inotify watch descriptor
+    self.__inotifyFd = self.__createInotify()
+    self.__thread = threading.Thread(target=self.__inotifyFd is None and self.__poll
+        or self.__watch, name='ConfigWatcher')
+    self.__thread.daemon = True
+    self.__thread.start()
+
+  def usesInotify(self):
+    """
+    Returns whether inotify is used instead of polling.
+
+    :rtype: bool
+    """
+    return self.__inotifyFd is not None
+
+  def __createInotify(self):
+    """
+    Method for create the inotify descriptor watching the parent directories.
+
+    :returns: The inotify descriptor or None when not available.
+    """
+    try:
+      import ctypes
+      import ctypes.util
+      libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+      fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    except (OSError, AttributeError):
+      return None # Not Linux
+    if fd < 0:
+      return None
+    mask = (self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE
+        | self.IN_DELETE)
+    for path in set([os.path.dirname(filename) for filename in self.__filenames]):
+      wd = libc.inotify_add_watch(fd, path, mask)
+      if wd < 0:
+        os.close(fd)
+        self.__directories.clear()
+        return None # Missing or unreadable directory
+      self.__directories[wd] = path
+    return fd
+
+  def __readEvents(self):
+    """
+    Method for read the pending inotify events.
+
+    :returns: The set of watched filenames changed.
+    """
+    import struct
+    changed = set()
+    try:
+      data = os.read(self.__inotifyFd, 65536)
+    except OSError:
+      return changed
+    offset = 0
+    while offset + 16 <= len(data):
+      wd, _, _, length = struct.unpack_from('iIII', data, offset)
+      name = data[offset + 16:offset + 16 + length].rstrip('\0')
+      offset += 16 + length
+      if wd in self.__directories:
+        filename = os.path.join(self.__directories[wd], name)
+        if filename in self.__filenames:
+          changed.add(filename)
+    return changed
+
+  def __watch(self):
+    """
+    Watcher thread body with inotify.
+    """
+    import select
+    try:
+      while not self.__stopped.isSet():
+        if not select.select([self.__inotifyFd], [], [], self.__interval)[0]:
+          continue
+        changed = self.__readEvents()
+        while select.select([self.__inotifyFd], [], [], self.QUIET_PERIOD)[0]:
+          changed.update(self.__readEvents())
+        if changed and not self.__stopped.isSet():
+          self.__notify(changed)
+    finally:
+      os.close(self.__inotifyFd)
+
+  def __stat(self, filename):
+    """
+    Method for get the modification key of a filename.
+    """
+    try:
+      stat = os.stat(filename)
+    except OSError:
+      return None
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+  def __poll(self):
+    """
+    Watcher thread body without inotify.
+    """
+    keys = dict([(filename, self.__stat(filename)) for filename in self.__filenames])
+    while not self.__stopped.wait(self.__interval):
+      changed = set()
+      for filename in self.__filenames:
+        key = self.__stat(filename)
+        if key != keys[filename]:
+          keys[filename] = key
+          changed.add(filename)
+      if changed:
+        self.__notify(changed)
+
+  def __notify(self, changed):
+    """
+    Method for call back, never stopping the watcher on errors.
+    """
+    try:
+      self.__callback(changed)
+    except Exception:
+      logging.getLogger().exception('Config watcher callback failed')
+
+  def stop(self):
+    """
+    Stops watching, waiting for the watcher thread.
+    """
+    self.__stopped.set()
+    self.__thread.join()
+
+
+def flattenConfig(data, prefix=''):
+  """
+  Flattens nested configuration dicts to a dict of dotted keys.
+
+  :param data: Configuration data.
+  :type data: dict
+
+  :param prefix: Prefix of the keys.
+  :type prefix: string
+
+  :returns: The {'section.name': value} dict of the leaf values.
+  :rtype: dict
+  """
+  flat = {}
+  for key, value in data.iteritems():
+    if isinstance(value, dict) and value:
+      flat.update(flattenConfig(value, '%s%s.' % (prefix, key)))
+    else:
+      flat['%s%s' % (prefix, key)] = value
+  return flat
+
+
+class Counter(object):
+  """
+  Metric counting events, only going up. Every thread adds to its own cell,
+  summed when read: no lock is taken on updates.
+
+  :param name: Metric name.
+  :type name: string
+
+  :param lock: Lock of the registry, taken to add the cell of a thread.
+  """
+  kind = 'counter'
+
+  def __init__(self, name, lock):
+    object.__init__(self)
+    self.name = name
+    self.__lock = lock
+    import threading
+    self.__local = threading.local()
+    self.__cells = []
+
+  def __addCell(self):
+    """
+    Method for create the cell of the current thread.
+    """
+    cell = self.__local.cell = [0]
+    with self.__lock:
+      self.__cells.append(cell)
+    return cell
+
+  def inc(self, amount=1):
+    """
+    Adds amount to the counter.
+    """
+    try:
+      self.__local.cell[0] += amount
+    except AttributeError:
+      self.__addCell()[0] += amount
+
+  def getValue(self):
+    """
+    Returns the counter value.
+    """
+    return sum([cell[0] for cell in self.__cells])
+
+  def getState(self):
+    """
+    Returns the metric state, as dumped in JSON.
+
+    :rtype: dict
+    """
+    return {'type': self.kind, 'value': self.getValue()}
+
+
+class Gauge(object):
+  """
+  Metric holding a value which goes up and down.
+
+  :param name: Metric name.
+  :type name: string
+
+  :param lock: Lock of the registry, taken on relative updates.
+  """
+  kind = 'gauge'
+
+  def __init__(self, name, lock):
+    object.__init__(self)
+    self.name = name
+    self.__lock = lock
+    self.__value = 0
+
+  def set(self, value):
+    """
+    Sets the gauge value.
+    """
+    self.__value = value
+
+  def inc(self, amount=1):
+    """
+    Adds amount to the gauge.
+    """
+    with self.__lock:
+      self.__value += amount
+
+  def dec(self, amount=1):
+    """
+    Subtracts amount from the gauge.
+    """
+    self.inc(-amount)
+
+  def getValue(self):
+    """
+    Returns the gauge value.
+    """
+    return self.__value
+
+  def getState(self):
+    """
+    Returns the metric state, as dumped in JSON.
+
+    :rtype: dict
+    """
+    return {'type': self.kind, 'value': self.__value}
+
+
+class Timer(object):
+  """
+  Metric timing a code path, as a decorator or with the context manager
+  returned by time, into a fixed memory histogram: one bucket per power of two
+  seconds, from 2**-20s (about 1us) to 2**19s (6 days), the durations up to
+  2**e seconds in the bucket of exponent e, plus the count, total and
+  maximum. Like counters, every thread updates its own cell.
+
+  :param name: Metric name.
+  :type name: string
+
+  :param lock: Lock of the registry, taken to add the cell of a thread.
+  """
+  kind = 'timer'
+  MIN_EXPONENT = -20
+  MAX_EXPONENT = 19
+  BUCKETS = MAX_EXPONENT - MIN_EXPONENT + 1
+  TINY = 2.0 ** (MIN_EXPONENT - 10)
+  # Exponent of TINY, the lowest seen: the cells hold buckets from it up, so
+  # the hot path never clamps low exponents, they are folded when read
+  LOW_EXPONENT = MIN_EXPONENT - 9
+
+  def __init__(self, name, lock):
+    object.__init__(self)
+    self.name = name
+    self.__lock = lock
+    import math
+    import threading
+    self.__frexp = math.frexp
+    self.__local = threading.local()
+    self.__cells = []
+    self.__block = self.__createBlockClass()
+
+  def __addCell(self):
+    """
+    Method for create the cell of the current thread: total, max and the
+    buckets, flat in a list. The count is the sum of the buckets.
+    """
+    cell = self.__local.cell = [0.0, 0.0] + [0] * (self.MAX_EXPONENT - self.LOW_EXPONENT + 1)
+    with self.__lock:
+      self.__cells.append(cell)
+    return cell
+
+  def observe(self, seconds):
+    """
+    Accounts a duration.
+
+    :param seconds: The duration in seconds.
+    :type seconds: float
+    """
+    try:
+      cell = self.__local.cell
+    except AttributeError:
+      cell = self.__addCell()
+    cell[0] += seconds
+    if seconds > cell[1]:
+      cell[1] = seconds
+    # frexp is cheaper than any log, seconds < 2**exponent, 0 in the first
+    exponent = self.__frexp(seconds + self.TINY)[1]
+    if exponent > self.MAX_EXPONENT:
+      exponent = self.MAX_EXPONENT
+    cell[exponent + 2 - self.LOW_EXPONENT] += 1
+
+  def __call__(self, function):
+    """
+    Decorates function timing its calls.
+    """
+    clock, frexp, local, addCell = time.time, self.__frexp, self.__local, self.__addCell
+    high, tiny, offset = self.MAX_EXPONENT, self.TINY, 2 - self.LOW_EXPONENT
+    def timed(*args, **kwargs):
+      started = clock()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        # observe inlined, a method call costs as much as the accounting
+        seconds = clock() - started
+        try:
+          cell = local.cell
+        except AttributeError:
+          cell = addCell()
+        cell[0] += seconds
+        if seconds > cell[1]:
+          cell[1] = seconds
+        exponent = frexp(seconds + tiny)[1]
+        if exponent > high:
+          exponent = high
+        cell[exponent + offset] += 1
+    timed.__name__, timed.__doc__ = function.__name__, function.__doc__
+    timed.__module__ = function.__module__
+    return timed
+
+  def __createBlockClass(self):
+    """
+    Method for create the class of the context managers returned by time.
+    Each holds its own start time, with observe inlined in __exit__.
+    """
+    timer, clock, frexp, local, addCell = self, time.time, self.__frexp, self.__local, self.__addCell
+    high, tiny, offset = self.MAX_EXPONENT, self.TINY, 2 - self.LOW_EXPONENT
+    class TimedBlock(object):
+      __slots__ = ('started',)
+
+      def __enter__(self):
+        self.started = clock()
+        return self
+
+      def __exit__(self, *_):
+        seconds = clock() - self.started
+        try:
+          cell = local.cell
+        except AttributeError:
+          cell = addCell()
+        cell[0] += seconds
+        if seconds > cell[1]:
+          cell[1] = seconds
+        exponent = frexp(seconds + tiny)[1]
+        if exponent > high:
+          exponent = high
+        cell[exponent + offset] += 1
+
+      def __call__(self, function):
+        return timer(function)
+    return TimedBlock
+
+  def time(self):
+    """
+    Returns a context manager timing a with statement block, which also
+    decorates functions as the timer does. Get one per with statement: they
+    hold their start time, so blocks may nest or run in threads.
+    """
+    return self.__block()
+
+  def getTotals(self):
+    """
+    Returns the count, total, max and buckets of all threads.
+
+    :rtype: tuple
+    """
+    low = self.MIN_EXPONENT - self.LOW_EXPONENT + 1
+    totals = [0.0, 0.0] + [0] * (self.MAX_EXPONENT - self.LOW_EXPONENT + 1)
+    for cell in list(self.__cells):
+      for index, value in enumerate(cell):
+        totals[index] = index == 1 and max(totals[1], value) or totals[index] + value
+    buckets = [sum(totals[2:2 + low])] + totals[2 + low:]
+    return sum(buckets), totals[0], totals[1], buckets
+
+  def getPercentile(self, percent, totals=None):
+    """
+    Returns the upper bound, in seconds, of the bucket holding the percent
+    percentile.
+
+    :rtype: float
+    """
+    count, _, maximum, buckets = totals or self.getTotals()
+    remaining = count * percent / 100.0
+    for index, qty in enumerate(buckets):
+      remaining -= qty
+      if remaining <= 0 and qty:
+        return min(2.0 ** (index + self.MIN_EXPONENT), maximum)
+    return maximum
+
+  def getState(self):
+    """
+    Returns the metric state, as dumped in JSON.
+
+    :rtype: dict
+    """
+    totals = self.getTotals()
+    return {'type': self.kind, 'count': totals[0], 'sum': totals[1], 'max': totals[2],
+        'p50': self.getPercentile(50, totals), 'p90': self.getPercentile(90, totals),
+        'p99': self.getPercentile(99, totals)}
+
+
+class Metrics(object):
+  """
+  Registry of named counters, gauges and timers, created on first use,
+  rendered in Prometheus text or JSON format and dumped periodically by a
+  background thread to a file or a Unix socket. Metrics are read while
+  being updated: a dump may miss the updates in flight.
+  """
+  FORMATS = ('prometheus', 'json')
+
+  def __init__(self):
+    object.__init__(self)
+    self.__metrics = {}
+    import threading
+    self.__threading = threading
+    self.__lock = threading.Lock()
+    self.__dumper = None
+    self.__stopped = threading.Event()
+
+  def __get(self, name, kind):
+    """
+    Method for get or create the name metric of kind class.
+
+    :raises ValueError: If name is already a metric of other kind.
+    """
+    metric = self.__metrics.get(name)
+    if metric is None:
+      with self.__lock:
+        metric = self.__metrics.setdefault(name, kind(name, self.__lock))
+    if not isinstance(metric, kind):
+      raise ValueError, 'metric %s is a %s' % (name, metric.kind)
+    return metric
+
+  def counter(self, name):
+    """
+    Returns the name Counter.
+    """
+    return self.__get(name, Counter)
+
+  def gauge(self, name):
+    """
+    Returns the name Gauge.
+    """
+    return self.__get(name, Gauge)
+
+  def timer(self, name):
+    """
+    Returns the name Timer.
+    """
+    return self.__get(name, Timer)
+
+  def render(self, format='prometheus'):
+    """
+    Returns the metrics in Prometheus text exposition format, timers as
+    histograms, or as a JSON object.
+
+    :param format: 'prometheus' or 'json'.
+    :type format: string
+
+    :rtype: string
+    """
+    metrics = sorted(self.__metrics.items())
+    if format == 'json':
+      import json
+      return json.dumps(dict([(name, metric.getState()) for name, metric in metrics]),
+          sort_keys=True)
+    lines = []
+    for name, metric in metrics:
+      name = re.sub(r'[^a-zA-Z0-9_:]', '_', name)
+      if metric.kind != 'timer':
+        value = metric.getValue()
+        lines.append('# TYPE %s %s' % (name, metric.kind))
+        lines.append('%s %s' % (name, isinstance(value, float) and repr(value) or str(value)))
+        continue
+      lines.append('# TYPE %s_seconds histogram' % name)
+      count, total, _, buckets = metric.getTotals()
+      cumulative, last = 0, max([0] + [index for index, qty in enumerate(buckets) if qty])
+      for index, qty in enumerate(buckets[:last + 1]):
+        cumulative += qty
+        lines.append('%s_seconds_bucket{le="%r"} %d' % (name, 2.0 ** (index + Timer.MIN_EXPONENT),
+            cumulative))
+      lines.append('%s_seconds_bucket{le="+Inf"} %d' % (name, count))
+      lines.append('%s_seconds_sum %r' % (name, total))
+      lines.append('%s_seconds_count %d' % (name, count))
+    return '\n'.join(lines) + '\n'
+
+  def dump(self, target, format='prometheus'):
+    """
+    Writes the rendered metrics to target: a filename, replaced atomically,
+    or "unix:" and the path of a listening Unix stream socket.
+
+    :param target: Filename or unix:path.
+    :type target: string
+
+    :param format: 'prometheus' or 'json'.
+    :type format: string
+
+    :raises IOError: If unable to write to target.
+    :raises socket.error: If unable to send to the socket.
+    """
+    text = self.render(format)
+    if target.startswith('unix:'):
+      import socket
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        sock.connect(target[5:])
+        sock.sendall(text)
+      finally:
+        sock.close()
+      return
+    tmpFilename = '%s.%d' % (target, os.getpid())
+    stream = open(tmpFilename, 'w')
+    try:
+      stream.write(text)
+    finally:
+      stream.close()
+    os.rename(tmpFilename, target)
+
+  def startDumping(self, target, interval=10.0, format='prometheus'):
+    """
+    Dumps the metrics to target every interval seconds, and at exit, from a
+    background thread.
+
+    :param target: Filename or unix:path.
+    :type target: string
+
+    :param interval: Seconds between dumps.
+    :type interval: float
+
+    :param format: 'prometheus' or 'json'.
+    :type format: string
+
+    :raises ValueError: If format is unknown.
+    """
+    if format not in self.FORMATS:
+      raise ValueError, 'unknown metrics format %s' % format
+    self.stopDumping()
+    def dumpForEver():
+      while not self.__stopped.wait(interval):
+        self.__dumpLogged(target, format)
+      self.__dumpLogged(target, format)
+    self.__stopped.clear()
+    self.__dumper = self.__threading.Thread(target=dumpForEver, name='MetricsDumper')
+    self.__dumper.daemon = True
+    self.__dumper.start()
+    atexit.register(self.stopDumping)
+
+  def __dumpLogged(self, target, format):
+    """
+    Method for dump never stopping the dumper on errors.
+    """
+    try:
+      self.dump(target, format)
+    except (IOError, OSError), e:
+      logging.getLogger().warning('Unable to dump metrics to %s: %s' % (target, e))
+
+  def stopDumping(self):
+    """
+    Stops the periodic dump, after a last one.
+    """
+    if self.__dumper is not None:
+      self.__stopped.set()
+      self.__dumper.join()
+      self.__dumper = None
+
+
+class StartupProfiler(object):
+  """
+  Startup profiler, enabled setting the APP_PROFILE_STARTUP environment
+  variable. Times every module imported after App, like python3 -X
+  importtime, wrapping the builtin __import__, and the steps of
+  App.parse_args. The breakdown is printed to stderr at exit.
+  """
+
+  def __init__(self):
+    object.__init__(self)
+    self.__import = __builtin__.__import__
+    self.__started = time.time()
+    self.__imports = []
+    self.__children = [0.0]
+    self.__steps = []
+
+  def install(self):
+    """
+    Starts timing the imports and registers the report at exit.
+    """
+    __builtin__.__import__ = self.__timedImport
+    atexit.register(self.report)
+
+  def __isLoaded(self, name, globals):
+    """
+    Method for check whether name, maybe relative to the importer package,
+    is already imported.
+    """
+    if sys.modules.get(name) is not None:
+      return True
+    globals = globals or {}
+    package = globals.get('__package__') or globals.get('__name__', '')
+    if not globals.has_key('__path__'):
+      package = package.rpartition('.')[0]
+    return bool(package) and sys.modules.get('%s.%s' % (package, name)) is not None
+
+  def __timedImport(self, name, globals=None, *args, **kwargs):
+    """
+    Replacement of __builtin__.__import__ timing the imports of new modules.
+    Nested imports are accounted apart, as -X importtime does.
+    """
+    if self.__isLoaded(name, globals):
+      return self.__import(name, globals, *args, **kwargs)
+    index = len(self.__imports)
+    self.__imports.append(None)
+    self.__children.append(0.0)
+    started = time.time()
+    try:
+      return self.__import(name, globals, *args, **kwargs)
+    finally:
+      cumulative = time.time() - started
+      children = self.__children.pop()
+      self.__children[-1] += cumulative
+      self.__imports[index] = (len(self.__children) - 1, name, cumulative - children,
+          cumulative)
+
+  def step(self, name, started):
+    """
+    Records the time spent in a named step since started.
+
+    :param name: Step name.
+    :type name: string
+
+    :param started: time.time() when the step started.
+    :type started: float
+    """
+    self.__steps.append((name, time.time() - started))
+
+  def report(self, stream=None):
+    """
+    Prints the imports, nested ones indented, and the steps timings.
+
+    :param stream: Stream to print to [stderr].
+    """
+    stream = stream or sys.stderr
+    stream.write('import time: self [us] | cumulative | imported package\n')
+    for level, name, own, cumulative in self.__imports:
+      stream.write('import time: %9d | %10d | %s%s\n' % (own * 1e6, cumulative * 1e6,
+          '  ' * level, name))
+    for name, elapsed in self.__steps:
+      stream.write('startup step: %9d us | %s\n' % (elapsed * 1e6, name))
+    stream.write('startup total: %9d us since App was imported\n' %
+        ((time.time() - self.__started) * 1e6))
+
+startupProfiler = None
+if os.environ.get('APP_PROFILE_STARTUP'):
+  startupProfiler = StartupProfiler()
+  startupProfiler.install()
+
+
 class App(object):
   """
   Application class, bundles optparse and logging together.
@@ -45,14 +909,29 @@ class App(object):
 
   :param usage: Usage string to use in the option parser.
   :type usage: string
+
+  :param configCache: Whether to cache the parsed configuration files.
+  :type configCache: bool
   """
+  # Format of the configuration files by extension, the rest are sniffed
+  CONFIG_EXTENSIONS = {'.json': 'JSON', '.yml': 'YAML', '.yaml': 'YAML',
+      '.ini': 'ConfigParser'}
+  CONFIG_CACHE_VERSION = 1
 
-  def __init__(self, appName=None, usage=None):
+  def __init__(self, appName=None, usage=None, configCache=True):
     object.__init__(self)
     self.__log = logging
     self.__appName = appName or 'app'
     self.__parser = optparse.OptionParser(usage=usage or '%prog [options]')
     self.__configFilenames = []
+    self.__configCache = configCache
+    self.__asyncLogging = None
+    self.__asyncHandler = None
+    self.__configData = {}
+    self.__configUpdates = {}
+    self.__configCallbacks = []
+    self.__configWatcher = None
+    self.__metrics = None
     self.config = {}
 
   def __createLoggingOpts(self):
@@ -96,6 +975,8 @@ class App(object):
 
     handler = self.__createStderrHandler(options.stderrLevel)
     handler.setFormatter(formatter)
+    if self.__asyncLogging is not None:
+      handler = self.__asyncHandler = AsyncHandler(handler, *self.__asyncLogging)
     logger.addHandler(handler)
 
     logger.setLevel(logging.DEBUG) # Global level
@@ -125,37 +1006,44 @@ class App(object):
     """
     self.__configFilenames.append(options.cfgFilename)
 
-  def __readSimplejsonFilename(self, filename):
+  def __readSimplejsonFilename(self, filename, text):
     """
     Method for read a simplejson formated filename.
 
-    :param filename: Filename to read.
+    :param filename: Filename read.
     :type filename: string
 
-    :raises IOError: If filename is not found.
+    :param text: Contents of the filename.
+    :type text: string
+
     :raises ValueError: If file is not json formated.
 
     :returns: The data dictionary of the json file.
     """
-    stream = open(filename)
-    data = simplejson.load(stream)
-    stream.close()
-    return data
+    import simplejson
+    return simplejson.loads(text)
 
-  def __readConfigParserFilename(self, filename):
+  def __readConfigParserFilename(self, filename, text):
     """
-    Method for read a simplejson formated filename.
+    Method for read a ConfigParser formated filename.
 
-    :param filename: Filename to read.
+    :param filename: Filename read.
     :type filename: string
 
-    :raises: ConfigParser.ParsingError: If unable to read/parse the filename
+    :param text: Contents of the filename.
+    :type text: string
+
+    :raises ValueError: If unable to parse the filename.
 
     :returns: The data dictionary of the ConfigParser file.
     """
+    import ConfigParser
+    import StringIO
     parser = ConfigParser.SafeConfigParser()
-    if not parser.read([filename]):
-      raise ConfigParser.ParsingError, 'Unable to read/parse file'
+    try:
+      parser.readfp(StringIO.StringIO(text), filename)
+    except ConfigParser.Error, e:
+      raise ValueError, str(e)
     data = {}
     for section in parser.sections():
       sectionData = {}
@@ -164,26 +1052,107 @@ class App(object):
       data[section] = sectionData
     return data
 
-  def __readYamlFilename(self, filename):
+  def __readYamlFilename(self, filename, text):
     """
     Method for read a YAML formated filename.
 
-    :param filename: Filename to read.
+    :param filename: Filename read.
     :type filename: string
 
-    :raises IOError: If filename is not found.
-    :raises AssertionError: If file is not YAML formatted.
+    :param text: Contents of the filename.
+    :type text: string
+
+    :raises ValueError: If file is not a single YAML document.
 
     :returns: The data dictionary of the YAML file.
     """
-    stream = open(filename)
+    import yaml
     try:
-      data = [item for item in yaml.safe_load_all(stream)]
-    except yaml.parser.ParserError:
-      assert False
-    assert len(data) == 1
+      data = [item for item in yaml.safe_load_all(text)]
+    except yaml.YAMLError, e:
+      raise ValueError, str(e)
+    if len(data) != 1:
+      raise ValueError, 'expected a single document, found %d' % len(data)
     return data[0]
 
+  def detectConfigFormat(self, filename, text):
+    """
+    Method for detecting a configuration file format, by its extension or
+    else sniffing its first significant line: JSON starts with "{" and
+    ConfigParser with a "[section]" header, anything else is YAML.
+
+    :param filename: Filename to detect the format of.
+    :type filename: string
+
+    :param text: Contents of the filename.
+    :type text: string
+
+    :returns: 'JSON', 'ConfigParser' or 'YAML'.
+    :rtype: string
+    """
+    configFormat = self.CONFIG_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+    if configFormat:
+      return configFormat
+    for line in text.splitlines():
+      line = line.strip()
+      if not line or line[0] in '#;':
+        continue
+      if line[0] == '{':
+        return 'JSON'
+      if re.match(r'\[[^\]]+\]$', line):
+        return 'ConfigParser'
+      break
+    return 'YAML'
+
+  def __getCacheFilename(self, filename):
+    """
+    Method for getting the cache filename, hidden next to filename.
+    """
+    path, name = os.path.split(filename)
+    return os.path.join(path, '.%s.cache' % name)
+
+  def __readCache(self, filename, key):
+    """
+    Method for read the cached data of filename, if still valid.
+
+    :returns: The cached data or None.
+    """
+    try:
+      stream = open(self.__getCacheFilename(filename), 'rb')
+    except IOError:
+      return None
+    try:
+      try:
+        version, cachedKey, data = marshal.load(stream)
+      except (EOFError, ValueError, TypeError):
+        return None
+    finally:
+      stream.close()
+    if version != self.CONFIG_CACHE_VERSION or cachedKey != key:
+      return None
+    return data
+
+  def __writeCache(self, filename, key, data):
+    """
+    Method for cache the data of filename. Best effort: the config
+    directory may not be writable and YAML may hold types marshal does not
+    support.
+    """
+    cacheFilename = self.__getCacheFilename(filename)
+    tmpFilename = '%s.%d' % (cacheFilename, os.getpid())
+    try:
+      blob = marshal.dumps((self.CONFIG_CACHE_VERSION, key, data))
+      stream = open(tmpFilename, 'wb')
+      try:
+        stream.write(blob)
+      finally:
+        stream.close()
+      os.rename(tmpFilename, cacheFilename) # Atomic for concurrent readers
+    except (ValueError, IOError, OSError), e:
+      self.__log.debug('Unable to cache "%s": %s' % (filename, e))
+      if os.path.exists(tmpFilename):
+        os.remove(tmpFilename)
+
   def updateConfig(self, data):
     """
     Method for update the public configuration data dictionary.
@@ -195,12 +1164,15 @@ class App(object):
     """
     if not isinstance(data, dict):
       raise ValueError, 'data must be a dict instance'
+    self.__configUpdates.update(data) # Kept on reloads
     self.config.update(data)
     self.__log.debug('Config dictionary successfully updated!')
 
   def parseConfigFilename(self, filename):
     """
-    Method for parsing configuration files.
+    Method for parsing configuration files. Each file is read and parsed
+    once, in the format detected by detectConfigFormat. The result is cached
+    next to the file, keyed by its modification time and size.
 
     :param filename: Filename to parse.
     :type filename: string
@@ -210,44 +1182,51 @@ class App(object):
     """
     self.__log.debug('Parsing configuration filename "%s".' % filename)
 
-    data = None
     try:
-      data = self.__readSimplejsonFilename(filename)
-    except IOError:
+      stat = os.stat(filename)
+    except OSError:
       self.__log.warning('Filename "%s" not found. Ignored.' % filename)
       return # We know is not found, aborting...
-    except ValueError:
-      self.__log.debug('Unable to parse "%s" in JSON format.' % filename)
-
-    if data:
-      if isinstance(data, dict):
+    key = (stat.st_mtime, stat.st_size)
+    if self.__configCache:
+      data = self.__readCache(filename, key)
+      if data is not None:
+        self.__log.debug('Filename "%s" read from its cache.' % filename)
         return data
-      else:
-        self.__log.warning('Filename "%s" in JSON format, but root must '
-            'be a dictionary. Ignored.' % filename)
-        return
 
     try:
-      data = self.__readConfigParserFilename(filename)
-    except ConfigParser.ParsingError:
-      self.__log.debug('Unable to parse "%s" in ConfigParser format.' %
-          filename)
-
-    try:
-      data = self.__readYamlFilename(filename)
+      stream = open(filename)
+      try:
+        text = stream.read()
+      finally:
+        stream.close()
     except IOError:
       self.__log.warning('Filename "%s" not found. Ignored.' % filename)
-      return # We know is not found, aborting...
-    except AssertionError:
-      self.__log.debug('Unable to parse "%s" in YAML format.' %
-          filename)
+      return
+
+    configFormat = self.detectConfigFormat(filename, text)
+    readers = {'JSON': self.__readSimplejsonFilename,
+        'ConfigParser': self.__readConfigParserFilename,
+        'YAML': self.__readYamlFilename}
+    try:
+      data = readers[configFormat](filename, text)
+    except ValueError, e:
+      self.__log.warning('Unable to parse "%s" in %s format: %s. Ignored.' %
+          (filename, configFormat, e))
+      return
+    if not isinstance(data, dict):
+      self.__log.warning('Filename "%s" in %s format, but root must '
+          'be a dictionary. Ignored.' % (filename, configFormat))
+      return
 
+    if self.__configCache:
+      self.__writeCache(filename, key, data)
     return data
 
   def __readConfigurationFilenames(self):
     """
-    Method for read all configuration filenames, in ConfigParser or
-    simplejson formats. Also can read mixed formats. The results of reading
+    Method for read all configuration filenames, in ConfigParser, simplejson
+    or YAML formats. Also can read mixed formats. The results of reading
     such files are stored on the *config* attribute. When reading a
     ConfigParser formated file, config will show a dictionary instead the
     well-known ConfigParser complex API.
@@ -258,7 +1237,140 @@ class App(object):
     for filename in self.__configFilenames:
       data = self.parseConfigFilename(filename)
       if data:
-        self.updateConfig(data)
+        self.__configData[filename] = data
+        self.config.update(data)
+
+  def __reloadConfigurationFilenames(self, filenames):
+    """
+    Method for re-parse the changed configuration filenames and swap in a
+    new config dict, calling back with the changes. A file which can not be
+    parsed keeps its previous data, a removed file drops its data.
+
+    :param filenames: The changed filenames.
+    :type filenames: set
+    """
+    for filename in self.__configFilenames:
+      if os.path.abspath(filename) not in filenames:
+        continue
+      self.__log.info('Reloading configuration filename "%s".' % filename)
+      if not os.path.exists(filename):
+        self.__configData.pop(filename, None)
+        continue
+      data = self.parseConfigFilename(filename)
+      if data is not None:
+        self.__configData[filename] = data
+    config = {}
+    for filename in self.__configFilenames:
+      config.update(self.__configData.get(filename, {}))
+    config.update(self.__configUpdates)
+    old, new = flattenConfig(self.config), flattenConfig(config)
+    changes = dict([(key, (old.get(key), new.get(key))) for key in set(old) | set(new)
+        if old.get(key) != new.get(key) or (key in old) != (key in new)])
+    self.config = config # Atomic, readers keep a consistent dict
+    if changes:
+      for callback in list(self.__configCallbacks):
+        try:
+          callback(changes)
+        except Exception:
+          self.__log.exception('Config change callback %r failed' % callback)
+
+  def addConfigCallback(self, callback):
+    """
+    Registers a callback of the config reloads, called from the watcher
+    thread with a dict of the changed dotted keys to their (old, new)
+    values, None when missing.
+
+    :param callback: Callable taking the changes dict.
+    :type callback: callable
+    """
+    self.__configCallbacks.append(callback)
+
+  def watchConfig(self, interval=1.0):
+    """
+    Starts reloading the configuration files when changed, to be called
+    after parse_args. The *config* attribute is then replaced by a new
+    dict on every reload, instead of updated: get it again when needed.
+
+    :param interval: Polling interval in seconds, without inotify.
+    :type interval: float
+    """
+    if self.__configWatcher is None:
+      self.__configWatcher = ConfigWatcher(self.__configFilenames,
+          self.__reloadConfigurationFilenames, interval)
+
+  def unwatchConfig(self):
+    """
+    Stops reloading the configuration files.
+    """
+    if self.__configWatcher is not None:
+      self.__configWatcher.stop()
+      self.__configWatcher = None
+
+  def enableAsyncLogging(self, capacity=10000, block=False, batchSize=256):
+    """
+    Makes the loggers created by parse_args write from a background thread
+    through an AsyncHandler, instead of on the logging thread.
+
+    :param capacity: Maximum number of queued records.
+    :type capacity: int
+
+    :param block: Whether to block instead of dropping when the queue is full.
+    :type block: bool
+
+    :param batchSize: Maximum number of records written per batch.
+    :type batchSize: int
+    """
+    self.__asyncLogging = (capacity, block, batchSize)
+
+  def getDroppedLogRecords(self):
+    """
+    Returns the number of log records dropped by the asynchronous logging.
+
+    :returns: The dropped records, 0 when logging synchronously.
+    :rtype: int
+    """
+    return self.__asyncHandler and self.__asyncHandler.getDropped() or 0
+
+  def getMetrics(self):
+    """
+    Returns the metrics registry, created on first use.
+
+    :returns: The metrics registry.
+    :rtype: Metrics
+    """
+    if self.__metrics is None:
+      self.__metrics = Metrics()
+    return self.__metrics
+
+  def timed(self, name):
+    """
+    Returns the name Timer context manager, see Timer.time, to decorate
+    functions or time a block with the with statement. As a decorator without
+    arguments the timer is named after the function.
+
+    :param name: Timer name, or the function to decorate.
+    :type name: string
+    """
+    if callable(name):
+      return self.getMetrics().timer('%s.%s' % (name.__module__, name.__name__))(name)
+    return self.getMetrics().timer(name).time()
+
+  def dumpMetrics(self, target, interval=10.0, format='prometheus'):
+    """
+    Dumps the metrics every interval seconds to a file or a Unix socket.
+
+    :param target: Filename or unix:path.
+    :type target: string
+
+    :param interval: Seconds between dumps.
+    :type interval: float
+
+    :param format: 'prometheus' or 'json'.
+    :type format: string
+
+    :raises ValueError: If format is unknown.
+    """
+    self.getMetrics().startDumping(target, interval, format)
 
   def add_option(self, *args, **kwargs):
     """
@@ -282,14 +1394,27 @@ class App(object):
       list.
     :rtype: tuple
     """
+    started = time.time()
     self.__createLoggingOpts()
     self.__createConfigOpts()
     (options, args) = self.__parser.parse_args()
+    self.__profileStep('parse_args options', started)
+    started = time.time()
     self.__createLoggers(options)
     self.__createConfigurators(options)
+    self.__profileStep('parse_args loggers', started)
+    started = time.time()
     self.__readConfigurationFilenames()
+    self.__profileStep('parse_args configuration', started)
     return (options, args)
 
+  def __profileStep(self, name, started):
+    """
+    Method for record a startup step when profiling the startup.
+    """
+    if startupProfiler is not None:
+      startupProfiler.step(name, started)
+
   def getLogger(self):
     """
     Returns the internal (global) generated logger.